@@ -1,5 +1,12 @@
 import sys, zlib
 
+# the rest of the server needs bytearray, memoryview, io.FileIO and the
+# newer bits of collections; say so clearly instead of dying halfway in.
+if sys.version_info < (2, 7):
+    sys.stderr.write('sshuttle server: python 2.7 or newer is needed, '
+                     'but this is %s.\n' % sys.version.split()[0])
+    sys.exit(1)
+
 z = zlib.decompressobj()
 mainmod = sys.modules[__name__]
 while 1:
@@ -1,7 +1,8 @@
-import struct, socket, select, errno, re, signal, time, threading
+import struct, socket, select, errno, re, signal, time, stat
 import compat.ssubprocess as ssubprocess
 import helpers, ssnet, ssh, ssyslog
 from ssnet import SockWrapper, Handler, Proxy, Mux, MuxWrapper
+from dnscache import DnsCache, dns_question, dns_answer
 from helpers import *
 
 _extra_fd = os.open('/dev/null', os.O_RDONLY)
@@ -96,16 +97,19 @@ def original_dst(sock):
 
 
 class FirewallClient:
-    def __init__(self, port, subnets_include, subnets_exclude, dnsport, udpport):
+    def __init__(self, port, subnets_include, subnets_exclude, dnsport, udpport,
+                 method='auto'):
         self.port = port
         self.auto_nets = []
+        self.sent = None
         self.subnets_include = subnets_include
         self.subnets_exclude = subnets_exclude
         self.dnsport = dnsport
         self.udpport = udpport
         argvbase = ([sys.argv[1], sys.argv[0], sys.argv[1]] +
                     ['-v'] * (helpers.verbose or 0) +
-                    ['--firewall', str(port), str(dnsport), str(udpport)])
+                    ['--firewall', str(port), str(dnsport), str(udpport),
+                     '--method=%s' % method])
         if ssyslog._p:
             argvbase += ['--syslog']
         argv_tries = [
@@ -150,12 +154,21 @@ class FirewallClient:
         if rv:
             raise Fatal('%r returned %d' % (self.argv, rv))
 
-    def start(self):
-        self.pfile.write('ROUTES\n')
+    def routes(self):
+        l = []
         for (ip,width) in self.subnets_include+self.auto_nets:
-            self.pfile.write('%d,0,%s\n' % (width, ip))
+            if (width,0,ip) not in l:
+                l.append((width,0,ip))
         for (ip,width) in self.subnets_exclude:
-            self.pfile.write('%d,1,%s\n' % (width, ip))
+            if (width,1,ip) not in l:
+                l.append((width,1,ip))
+        return l
+
+    def start(self):
+        self.pfile.write('ROUTES\n')
+        self.sent = self.routes()
+        for route in self.sent:
+            self.pfile.write('%d,%d,%s\n' % route)
         self.pfile.write('GO\n')
         self.pfile.flush()
         line = self.pfile.readline()
@@ -163,6 +176,33 @@ class FirewallClient:
         if line != 'STARTED\n':
             raise Fatal('%r expected STARTED, got %r' % (self.argv, line))
 
+    # Call this after changing subnets_include, subnets_exclude or auto_nets.
+    # Only the routes that changed since the firewall manager last said OK
+    # go to it, and it changes its rules in place, so the sessions we're
+    # already forwarding don't notice.  If it can't, we raise Fatal, and
+    # the next reroute() tries those changes again.
+    def reroute(self):
+        if self.sent is None:
+            return  # not started yet; start() will send them all
+        new = self.routes()
+        gone = [r for r in self.sent if r not in new]
+        added = [r for r in new if r not in self.sent]
+        if not gone and not added:
+            return
+        for route in gone:
+            self.pfile.write('DEL_ROUTE %d,%d,%s\n' % route)
+        for route in added:
+            self.pfile.write('ADD_ROUTE %d,%d,%s\n' % route)
+        self.pfile.write('GO\n')
+        self.pfile.flush()
+        line = self.pfile.readline()
+        self.check()
+        if line.startswith('ROUTES_FAILED '):
+            raise Fatal(line[14:].strip())
+        elif line != 'ROUTES_OK\n':
+            raise Fatal('%r expected ROUTES_OK, got %r' % (self.argv, line))
+        self.sent = new
+
     def sethostip(self, hostname, ip):
         assert(not re.search(r'[^-\w]', hostname))
         assert(not re.search(r'[^0-9.]', ip))
@@ -208,125 +248,316 @@ def onaccept(listener, mux, handlers):
         sock.close()
         return
     mux.send(chan, ssnet.CMD_CONNECT, '%s,%s' % dstip)
-    outwrap = MuxWrapper(mux, chan)
+    outwrap = MuxWrapper(mux, chan, ssnet.PORT_WEIGHTS.get(dstip[1], 1))
     handlers.append(Proxy(SockWrapper(sock, sock), outwrap))
 
 
+# dnsreqs maps a channel to the DNS question it's asking the server:
+# [peer,sock,timer,request,key,waiters], where waiters are other
+# (peer,request,qend) that asked the same question in the meantime.
 dnsreqs = {}
+dnspending = {}  # question key -> channel
+dnscache = DnsCache()
 def dns_done(chan, data):
-    peer,sock,timeout = dnsreqs.get(chan) or (None,None,None)
+    peer,sock,timer,request,key,waiters = \
+        dnsreqs.get(chan) or (None,None,None,None,None,None)
     debug3('dns_done: channel=%r peer=%r\n' % (chan, peer))
     if peer:
         del dnsreqs[chan]
+        timer.cancel()
+        if key:
+            del dnspending[key]
+            dnscache.put(request, data)
         debug3('doing sendto %r\n' % (peer,))
         sock.sendto(data, peer)
+        for (peer,request,qend) in waiters:
+            debug3('doing sendto %r\n' % (peer,))
+            sock.sendto(dns_answer(request, qend, data), peer)
+
+
+def dns_expire(chan):
+    key = dnsreqs.pop(chan)[4]
+    if key:
+        del dnspending[key]
+    debug3('Remaining DNS requests: %d\n' % len(dnsreqs))
 
 
 def ondns(listener, mux, handlers):
     pkt,peer = listener.recvfrom(4096)
-    now = time.time()
     if pkt:
         debug1('DNS request from %r: %d bytes\n' % (peer, len(pkt)))
-        chan = mux.next_channel()
-        dnsreqs[chan] = peer,listener,now+30
-        mux.send(chan, ssnet.CMD_DNS_REQ, pkt)
-        mux.channels[chan] = lambda cmd,data: dns_done(chan,data)
-    for chan,(peer,sock,timeout) in dnsreqs.items():
-        if timeout < now:
-            del dnsreqs[chan]
-    debug3('Remaining DNS requests: %d\n' % len(dnsreqs))
-
-class udp_thread(threading.Thread):
+        response = dnscache.get(pkt)
+        q = dns_question(pkt)
+        chan = q and dnspending.get(q[1])
+        if response:
+            debug2('DNS response from cache (%d hits, %d misses).\n'
+                   % (dnscache.hits, dnscache.misses))
+            listener.sendto(response, peer)
+        elif chan:
+            # somebody already asked; answer both when the reply comes
+            dnsreqs[chan][5].append((peer, pkt, q[2]))
+        else:
+            chan = mux.next_channel()
+            key = q and q[1]
+            timer = handlers.timers.add(30, lambda: dns_expire(chan))
+            dnsreqs[chan] = [peer,listener,timer,pkt,key,[]]
+            if key:
+                dnspending[key] = chan
+            mux.send(chan, ssnet.CMD_DNS_REQ, pkt)
+            mux.channels[chan] = lambda cmd,data: dns_done(chan,data)
+
+class udp_proxy(Handler):
+    # Carries UDP between the firewall process and the mux, in the main
+    # loop.  The firewall connects once to udp_server, then sends us the raw
+    # IP packets it captures as a DatagramStream; replies go the other way
+    # with a short header.  Replies are queued up and written together the
+    # next time round the loop, or once the socket is writable if the
+    # firewall is busy.
     udp_channel_timeout = 600
     ip_packet_format = '!BBHHHBBH4s4s'
     def __init__(self, udp_server, udp_forward, mux, handlers):
-        threading.Thread.__init__(self)
+        Handler.__init__(self, [udp_server])
         self.udp_server = udp_server
         self.udp_forward = udp_forward
+        self.udp_listener = None
+        self.stream = None
         self.mux = mux
         self.handlers = handlers
         self.channels = {} # Dictionary mapping tuples (source_port, destination, destination_port) to lists [source, channel, timeout]
         self.forward_channel = None
-    def run(self):
+    def onaccept(self):
         self.udp_listener, self.address = self.udp_server.accept()
-        self.handlers.append(Handler([self.udp_listener], self.onudp))
+        self.stream = ssnet.DatagramStream(self.udp_listener)
+        self.socks = [self.udp_listener]
         if self.udp_forward:
             self.forward_channel = self.mux.next_channel()
             self.mux.channels[self.forward_channel] = self.onudpback
             for p in self.udp_forward:
                 self.mux.send(self.forward_channel, ssnet.CMD_UDP_FWD, struct.pack('!H', p))
-    def tick(self):
-        now = time.time()
-        for c, v in self.channels.items():
-            if v[2] < now:
-                del self.mux.channels[v[1]]
-                del self.channels[c]
+    def expire(self, key):
+        v = self.channels.pop(key)
+        del self.mux.channels[v[1]]
     def openchannel(self, source, source_port, destination, destination_port):
         key = source_port, destination, destination_port
-        if key not in self.channels:
+        v = self.channels.get(key)
+        if not v:
             chan = self.mux.next_channel()
-            self.channels[key] = [source, chan, time.time() + udp_thread.udp_channel_timeout]
+            v = [source, chan, time.time() + udp_proxy.udp_channel_timeout]
+            self.channels[key] = v
             self.mux.channels[chan] = self.onudpback
+            self.handlers.timers.add_deadline(lambda: v[2],
+                                              lambda: self.expire(key))
         else:
-            chan = self.channels[key][1]
-            self.channels[key][2] = time.time() + udp_thread.udp_channel_timeout
-        return chan
-    def onudp(self):
-        self.tick()
-        ip_header_bytes = self.udp_listener.recv(20)
-        if len(ip_header_bytes) >= 20:
-            ip_header = struct.unpack(udp_thread.ip_packet_format, ip_header_bytes)
-            ip_header_length = (ip_header[0] & 0xF) * 4
-            total_length = ip_header[2]
-            source = ip_header[8]
-            destination = ip_header[9]
-            if ip_header_length > 20:
-                self.udp_listener.recv(ip_header_length - 20) # Skip IP options and stuff
-            udp_packet = self.udp_listener.recv(total_length - ip_header_length)
-            if not helpers.islocal(socket.inet_ntoa(source)):
-                return
-            if len(udp_packet) >= 8:
-                udp_header = struct.unpack('!HHHH', udp_packet[:8])
-                source_port = udp_header[0]
-                destination_port = udp_header[1]
-                udp_content = udp_packet[8:]
-                debug2('UDP packet to %s:%d of %d bytes\n' % (socket.inet_ntoa(destination), destination_port, len(udp_packet)))
-                chan = self.openchannel(source, source_port, destination, destination_port)
-                self.mux.send(chan, ssnet.CMD_UDP_OUT, struct.pack('!H4sH', source_port, destination, destination_port) + udp_content)
+            v[2] = time.time() + udp_proxy.udp_channel_timeout
+        return v[1]
+    def pre_select(self, r, w, x):
+        Handler.pre_select(self, r, w, x)
+        if self.stream and self.stream.has_output():
+            w.append(self.udp_listener)
+    def callback(self):
+        if not self.udp_listener:
+            return self.onaccept()
+        self.stream.flush()
+        for packet in self.stream.read():
+            self.onudp(packet)
+        if not self.stream.ok:
+            debug1('firewall: UDP connection closed.\n')
+            self.ok = False
+    def onudp(self, packet):
+        if len(packet) < 20:
+            return
+        ip_header = struct.unpack_from(udp_proxy.ip_packet_format, packet)
+        ip_header_length = (ip_header[0] & 0xF) * 4
+        source = ip_header[8]
+        destination = ip_header[9]
+        if len(packet) - ip_header_length < 8 or not helpers.islocal(socket.inet_ntoa(source)):
+            return
+        (source_port, destination_port) = struct.unpack_from('!HH', packet, ip_header_length)
+        if helpers.verbose >= 2:
+            debug2('UDP packet to %s:%d of %d bytes\n', socket.inet_ntoa(destination), destination_port, len(packet) - ip_header_length)
+        chan = self.openchannel(source, source_port, destination, destination_port)
+        self.mux.send(chan, ssnet.CMD_UDP_OUT, struct.pack('!H4sH', source_port, destination, destination_port) + packet[ip_header_length+8:])
     def onudpback(self, chan, data):
-        self.tick()
         key = struct.unpack('!H4sH', data[:8])
-        if key in self.channels:
-            self.channels[key][2] = time.time() + udp_thread.udp_channel_timeout # Update timeout
-            source = self.channels[key][0]
+        v = self.channels.get(key)
+        if v:
+            v[2] = time.time() + udp_proxy.udp_channel_timeout # Update timeout
+            source = v[0]
         else:
             source = '\x00\x00\x00\x00' # Unknown source
         remote, remote_port = struct.unpack('!4sH', data[8:14])
-        udp_content = data[14:]
-        miniheader = struct.pack('!H4sH4sH', len(udp_content), source, key[0], remote, remote_port)
-        self.udp_listener.send(miniheader + udp_content)
+        miniheader = struct.pack('!4sH4sH', source, key[0], remote, remote_port)
+        if not self.stream.has_output():
+            self.wake()  # to flush() it
+        self.stream.queue(miniheader + data[14:])
+
+
+# A connection to the --control socket.  It takes one command per line:
+#   add <subnet>      route this subnet over the VPN
+#   exclude <subnet>  don't route this subnet
+#   del <subnet>      forget about this subnet (added or excluded)
+#   list              print the current routes
+# and answers each one with 'ok' or 'error: <why>'.
+class ControlConnection(Handler):
+    def __init__(self, sock, fw):
+        Handler.__init__(self, [sock])
+        self.sock = sock
+        self.fw = fw
+        self.buf = ''
+
+    def callback(self):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error:
+            data = ''
+        if not data:
+            self.sock.close()
+            self.ok = False
+            return
+        self.buf += data
+        while '\n' in self.buf:
+            (line, self.buf) = self.buf.split('\n', 1)
+            try:
+                reply = self.command(line.split())
+            except Fatal, e:
+                reply = 'error: %s\n' % e
+            try:
+                self.sock.sendall(reply)
+            except socket.error:
+                pass
+
+    def command(self, words):
+        fw = self.fw
+        if words == ['list']:
+            return ''.join(['%s %s/%d\n' % (exclude and 'exclude' or 'add',
+                                            ip, width)
+                            for (width,exclude,ip) in fw.routes()]) + 'ok\n'
+        if len(words) != 2 or words[0] not in ('add', 'exclude', 'del'):
+            raise Fatal('expected add, exclude or del <subnet>, or list')
+        [subnet] = parse_subnets(words[1:])
+        lists = (fw.subnets_include, fw.subnets_exclude, fw.auto_nets)
+        saved = [list(l) for l in lists]
+        for l in lists:
+            while subnet in l:
+                l.remove(subnet)
+        if words[0] == 'add':
+            fw.subnets_include.append(subnet)
+        elif words[0] == 'exclude':
+            fw.subnets_exclude.append(subnet)
+        debug1('control: %s %s/%d\n' % (words[0], subnet[0], subnet[1]))
+        try:
+            fw.reroute()
+        except Fatal:
+            for (l, old) in zip(lists, saved):
+                l[:] = old
+            raise
+        return 'ok\n'
+
+
+def oncontrol(listener, fw, handlers):
+    try:
+        sock,addr = listener.accept()
+    except socket.error:
+        return
+    handlers.append(ControlConnection(sock, fw))
+
+
+def listen_control(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        st = None
+    if st and not stat.S_ISSOCK(st.st_mode):
+        raise Fatal('--control: %r exists and is not a socket' % path)
+    elif st:
+        os.unlink(path)  # left over from an earlier run
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # nobody else gets to change our routes, not even for a moment
+    oldmask = os.umask(0177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(oldmask)
+    sock.listen(5)
+    return sock
+
+
+def start_workers(count, listenip, inherited, ssh_cmd, remotename, python,
+                  latency_control, frame_size, transports, syslog, daemon):
+    # Each extra worker is a whole client process with its own ssh session
+    # and server, and its own listener on the transproxy port.  The kernel
+    # spreads new connections across all the listeners (SO_REUSEPORT), so
+    # we aren't limited to one CPU and one ssh cipher stream.  Workers only
+    # carry TCP; DNS, UDP, routes and hosts stay with the main process.
+    #
+    # Every worker gets a socketpair back to us: when either end exits, the
+    # other one sees EOF.
+    workers = []
+    for i in xrange(1, count):
+        (mine, theirs) = socket.socketpair()
+        pid = os.fork()
+        if not pid:
+            mine.close()
+            for s in inherited:
+                if s:
+                    s.close()
+            for (pid,s) in workers:
+                s.close()
+            _worker(i, theirs, listenip, ssh_cmd, remotename, python,
+                    latency_control, frame_size, transports, syslog, daemon)
+            # not reached
+        theirs.close()
+        workers.append((pid, mine))
+    return workers
+
+
+def _worker(i, parent, listenip, ssh_cmd, remotename, python,
+            latency_control, frame_size, transports, syslog, daemon):
+    rv = 1
+    try:
+        try:
+            if daemon:
+                # the main process will detach from the terminal later on
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            listener = socket.socket()
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listener.bind(listenip)
+            listener.listen(10)
+            rv = _main(listener, None, ssh_cmd, remotename, python,
+                       latency_control, frame_size, None, None, None,
+                       None, False, syslog or daemon, False,
+                       worker=(i, parent), transports=transports)
+        except SystemExit, e:
+            rv = e.code
+        except Fatal, e:
+            log('fatal: %s\n' % e)
+            rv = 99
+        except KeyboardInterrupt:
+            pass
+        except:
+            import traceback
+            traceback.print_exc()
+    finally:
+        # never fall back into our parent's stack
+        sys.stderr.flush()
+        os._exit(rv or 0)
 
-def _main(listener, fw, ssh_cmd, remotename, python, latency_control,
-          dnslistener, udp_server, udp_forward, seed_hosts, auto_nets,
-          syslog, daemon):
-    handlers = []
-    if helpers.verbose >= 1:
-        helpers.logprefix = 'c : '
-    else:
-        helpers.logprefix = 'client: '
-    debug1('connecting to server...\n')
 
+def connect_server(ssh_cmd, remotename, python, latency_control, frame_size,
+                   auto_nets=False):
     try:
         (serverproc, serversock) = ssh.connect(ssh_cmd, remotename, python,
                         stderr=ssyslog._p and ssyslog._p.stdin,
-                        options=dict(latency_control=latency_control))
+                        options=dict(latency_control=latency_control,
+                                     frame_size=frame_size,
+                                     auto_nets=bool(auto_nets)))
     except socket.error, e:
         if e.args[0] == errno.EPIPE:
             raise Fatal("failed to establish ssh session (1)")
         else:
             raise
     mux = Mux(serversock, serversock)
-    handlers.append(mux)
 
     expected = 'SSHUTTLE0001'
 
@@ -351,6 +582,74 @@ def _main(listener, fw, ssh_cmd, remotename, python, latency_control,
     if initstring != expected:
         raise Fatal('expected server init string %r; got %r'
                         % (expected, initstring))
+    # the server tells us the largest frame size it's willing to use, which
+    # is never more than what we asked for.
+    (mux.frame_size,) = struct.unpack('!H', serversock.recv(2))
+    debug1('frame size = %d\n' % mux.frame_size)
+    return (serverproc, serversock, mux)
+
+
+def _main(listener, fw, ssh_cmd, remotename, python, latency_control,
+          frame_size, dnslistener, udp_server, udp_forward, seed_hosts, auto_nets,
+          syslog, daemon, workers=None, worker=None, transports=1,
+          control=None):
+    handlers = ssnet.HandlerSet()
+    if worker:
+        if helpers.verbose >= 1:
+            helpers.logprefix = 'c%d: ' % worker[0]
+        else:
+            helpers.logprefix = 'client %d: ' % worker[0]
+    elif helpers.verbose >= 1:
+        helpers.logprefix = 'c : '
+    else:
+        helpers.logprefix = 'client: '
+    debug1('connecting to server...\n')
+    (serverproc, serversock, mux) = connect_server(ssh_cmd, remotename, python,
+                                                   latency_control, frame_size,
+                                                   auto_nets)
+    handlers.append(mux)
+
+    # Extra ssh connections, so TCP sessions don't all share (and stall
+    # on) one TCP window.  Each has a server of its own and only carries
+    # TCP channels; if one dies, we only lose the channels that were on it.
+    extras = []
+    for i in xrange(1, transports):
+        debug1('connecting transport %d...\n' % i)
+        try:
+            extra = connect_server(ssh_cmd, remotename, python,
+                                   latency_control, frame_size)
+        except Fatal, e:
+            log('transport %d: %s\n' % (i, e))
+            continue
+        # every server sends its routes, but the first one's are enough
+        extra[2].got_routes = lambda routestr: None
+        extra[2].primary = False
+        handlers.append(extra[2])
+        extras.append(extra)
+    muxes = [mux] + [m for (p,s,m) in extras]
+
+    def pickmux():
+        # the least busy transport; rotating first makes ties go round robin
+        muxes.append(muxes.pop(0))
+        return min([m for m in muxes if m.ok] or [mux],
+                   key=lambda m: (m.too_full, m.fullness // ssnet.MIN_BUDGET))
+
+    def droptransport(extra):
+        (p, s, m) = extra
+        log('lost an ssh transport; resetting its %d connections.\n'
+            % len([c for c in m.channels.values() if c]))
+        m.lost()
+        handlers.remove(m)
+        extras.remove(extra)
+        muxes.remove(m)
+        s.close()
+        if p.poll() is None:
+            try:
+                p.kill()
+            except OSError:
+                pass  # exited in the meantime
+        p.wait()
+
     debug1('connected.\n')
     sys.stdout.flush()
     if daemon:
@@ -374,9 +673,29 @@ def _main(listener, fw, ssh_cmd, remotename, python, latency_control,
         # set --auto-nets, we might as well wait for the message first, then
         # ignore its contents.
         mux.got_routes = None
-        fw.start()
+        if fw:
+            fw.start()
     mux.got_routes = onroutes
 
+    def onroutechanges(changes):
+        if not auto_nets or not fw:
+            return
+        for line in changes.strip().split('\n'):
+            (ip,width) = line[1:].split(',', 1)
+            route = (ip,int(width))
+            if line[0] == '+':
+                if route not in fw.auto_nets:
+                    fw.auto_nets.append(route)
+            else:
+                while route in fw.auto_nets:
+                    fw.auto_nets.remove(route)
+        debug1('server routes changed; updating firewall.\n')
+        try:
+            fw.reroute()
+        except Fatal, e:
+            log('could not update routes: %s\n' % e)
+    mux.got_route_changes = onroutechanges
+
     def onhostlist(hostlist):
         debug2('got host list: %r\n' % hostlist)
         for line in hostlist.strip().split():
@@ -385,13 +704,42 @@ def _main(listener, fw, ssh_cmd, remotename, python, latency_control,
                 fw.sethostip(name, ip)
     mux.got_host_list = onhostlist
 
-    handlers.append(Handler([listener], lambda: onaccept(listener, mux, handlers)))
+    handlers.append(Handler([listener],
+                            lambda: onaccept(listener, pickmux(), handlers)))
 
     if dnslistener:
         handlers.append(Handler([dnslistener], lambda: ondns(dnslistener, mux, handlers)))
 
     if udp_server:
-        udp_thread(udp_server, udp_forward, mux, handlers).start()
+        handlers.append(udp_proxy(udp_server, udp_forward, mux, handlers))
+
+    if control:
+        handlers.append(Handler([control],
+                                lambda: oncontrol(control, fw, handlers)))
+
+    if worker:
+        def onparentexit(parent):
+            if not parent.recv(1):
+                debug1('main client process is gone; exiting.\n')
+                sys.exit(0)
+        handlers.append(Handler([worker[1]],
+                                lambda: onparentexit(worker[1])))
+
+    def onworkerexit(h, pid, sock):
+        if sock.recv(1):
+            return
+        try:
+            (pid, rv) = os.waitpid(pid, 0)
+            log('worker process %d exited (status %d).\n' % (pid, rv))
+        except OSError:
+            # after --daemon, the workers aren't our children anymore
+            log('worker process %d exited.\n' % pid)
+        sock.close()
+        h.ok = False
+    for (pid, sock) in workers or []:
+        h = Handler([sock])
+        h.callback = lambda h=h, pid=pid, sock=sock: onworkerexit(h, pid, sock)
+        handlers.append(h)
 
     if seed_hosts != None:
         debug1('seed_hosts: %r\n' % seed_hosts)
@@ -401,14 +749,27 @@ def _main(listener, fw, ssh_cmd, remotename, python, latency_control,
         rv = serverproc.poll()
         if rv:
             raise Fatal('server died with error code %d' % rv)
+        for extra in extras[:]:
+            if not extra[2].ok or extra[0].poll() is not None:
+                droptransport(extra)
+            else:
+                handlers.touch(extra[2])
         ssnet.runonce(handlers, mux)
-        if latency_control:
-            mux.check_fullness()
-        mux.callback()
-
-def main(listenip, ssh_cmd, remotename, python, latency_control, dns, udp, udp_forward,
+        for m in muxes:
+            if not m.ok and m is not mux:
+                continue  # dropped next time around
+            if latency_control:
+                m.check_fullness()
+            m.callback()
+
+def main(listenip, ssh_cmd, remotename, python, latency_control, frame_size,
+         dns, udp, udp_forward,
          seed_hosts, auto_nets,
-         subnets_include, subnets_exclude, syslog, daemon, pidfile):
+         subnets_include, subnets_exclude, syslog, daemon, pidfile,
+         workers=1, transports=1, method='auto', control_path=None):
+    if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        raise Fatal('--workers needs SO_REUSEPORT, '
+                    'which this system does not support')
     if syslog:
         ssyslog.start_syslog()
     if daemon:
@@ -430,6 +791,8 @@ def main(listenip, ssh_cmd, remotename, python, latency_control, dns, udp, udp_f
         debug2(' %d' % port)
         listener = socket.socket()
         listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if workers > 1:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         dnslistener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         dnslistener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
@@ -473,13 +836,37 @@ def main(listenip, ssh_cmd, remotename, python, latency_control, dns, udp, udp_f
         dnsport = 0
         dnslistener = None
 
-    fw = FirewallClient(listenip[1], subnets_include, subnets_exclude, dnsport, udpport)
+    workerlist = []
+    if workers > 1:
+        debug1('Starting %d more workers.\n' % (workers-1))
+        workerlist = start_workers(workers, listenip,
+                                   [listener, dnslistener, udp_server],
+                                   ssh_cmd, remotename, python,
+                                   latency_control, frame_size,
+                                   transports, syslog, daemon)
+
+    control = None
+    if control_path:
+        control_path = os.path.abspath(control_path)  # --daemon does chdir
+        control = listen_control(control_path)
+        debug1('Control socket listening on %r.\n' % control_path)
+
+    fw = FirewallClient(listenip[1], subnets_include, subnets_exclude, dnsport, udpport,
+                        method)
 
     try:
         return _main(listener, fw, ssh_cmd, remotename,
-                     python, latency_control, dnslistener, udp_server, udp_forward,
-                     seed_hosts, auto_nets, syslog, daemon)
+                     python, latency_control, frame_size,
+                     dnslistener, udp_server, udp_forward,
+                     seed_hosts, auto_nets, syslog, daemon,
+                     workerlist, transports=transports, control=control)
     finally:
+        if control:
+            control.close()
+            try:
+                os.unlink(control_path)
+            except OSError:
+                pass
         try:
             if daemon:
                 # it's not our child anymore; can't waitpid
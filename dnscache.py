@@ -0,0 +1,193 @@
+import struct, time, collections
+
+# Caches DNS answers, keyed by the question (name, type and class, plus the
+# RD and CD flags, which can change the answer) and what the asker said
+# about EDNS (RFC 6891): whether it sent an OPT record at all, its DO bit
+# and its UDP payload size, since those decide whether the answer may have
+# an OPT record, DNSSEC records, or more than 512 bytes.  Entries live as
+# long as the smallest TTL in the answer, or for negative answers (NXDOMAIN
+# and NODATA) as long as the SOA in the authority section says, like RFC
+# 2308.
+# When the cache is full, the least recently used entry goes first.
+DNS_CACHE_SIZE = 4096
+DNS_MAX_TTL = 86400
+DNS_MAX_NEGATIVE_TTL = 900
+
+DNS_TYPE_SOA = 6
+DNS_TYPE_OPT = 41  # EDNS0 pseudo-record; its "TTL" field is really flags
+DNS_EDNS_DO = 0x8000  # in the OPT record's flags: DNSSEC OK
+DNS_MIN_PAYLOAD = 512
+
+
+def _dns_skip_name(pkt, pos):
+    # returns the offset just past the (possibly compressed) name at pos
+    while 1:
+        n = ord(pkt[pos])
+        if n == 0:
+            return pos + 1
+        elif n & 0xc0 == 0xc0:
+            return pos + 2
+        elif n & 0xc0:
+            raise ValueError('unsupported DNS label type 0x%02x' % n)
+        pos += 1 + n
+
+
+def _dns_edns(pkt, pos, count):
+    # Returns (edns, payload) for the count records at pos in a query:
+    # edns is 0 without an OPT record, or 1 plus its DO bit; payload is the
+    # UDP size the asker can take.  Raises ValueError for anything else in
+    # there, like TSIG, or EDNS options such as cookies or client subnet,
+    # which are particular to one asker.
+    edns = 0
+    payload = DNS_MIN_PAYLOAD
+    for i in xrange(count):
+        pos = _dns_skip_name(pkt, pos)
+        (rtype, rclass, ttl, rdlen) = struct.unpack('!HHIH', pkt[pos:pos+10])
+        pos += 10 + rdlen
+        if rtype != DNS_TYPE_OPT or edns or rdlen:
+            raise ValueError('not a plain EDNS query')
+        edns = 1 | (ttl & DNS_EDNS_DO)
+        payload = max(rclass, DNS_MIN_PAYLOAD)
+    if pos != len(pkt):
+        raise ValueError('junk after the last record')
+    return (edns, payload)
+
+
+def dns_question(pkt):
+    # Returns (id, key, qend) for a standard query with exactly one
+    # question, where pkt[12:qend] is the question section.  Returns None
+    # for anything we don't want to cache.
+    if len(pkt) < 12:
+        return None
+    (qid, flags, qdcount, ancount, nscount, arcount) = \
+        struct.unpack('!HHHHHH', pkt[:12])
+    if flags & 0xf800 or qdcount != 1 or ancount or nscount:
+        return None  # a response, or not a standard QUERY
+    try:
+        nend = _dns_skip_name(pkt, 12)
+        qend = nend + 4
+        if qend > len(pkt):
+            return None
+        (edns, payload) = _dns_edns(pkt, qend, arcount)
+    except (IndexError, ValueError, struct.error):
+        return None
+    # names are case insensitive; the label lengths (at most 63) never get
+    # mangled by lower().
+    key = (pkt[12:nend].lower() + pkt[nend:qend]
+           + struct.pack('!HHH', flags & 0x0110, edns, payload))
+    return (qid, key, qend)
+
+
+def dns_ttl(pkt):
+    # Returns (ttl, offsets): how long we may cache the response pkt, and
+    # where its TTL fields are, so we can count them down later.  Raises
+    # ValueError (or IndexError, or struct.error) if pkt is malformed.
+    (flags, qdcount, ancount, nscount, arcount) = \
+        struct.unpack('!HHHHH', pkt[2:12])
+    rcode = flags & 0x000f
+    if flags & 0x0200:
+        return (0, [])  # truncated; the client will retry over TCP
+    pos = 12
+    for i in xrange(qdcount):
+        pos = _dns_skip_name(pkt, pos) + 4
+    offsets = []
+    answer_ttl = negative_ttl = None
+    for i in xrange(ancount + nscount + arcount):
+        pos = _dns_skip_name(pkt, pos)
+        (rtype, rclass, ttl, rdlen) = struct.unpack('!HHIH', pkt[pos:pos+10])
+        rdata = pos + 10
+        if rdata + rdlen > len(pkt):
+            raise ValueError('DNS record runs past the end of the packet')
+        if rtype != DNS_TYPE_OPT:
+            offsets.append(pos + 4)
+            if i < ancount:
+                if answer_ttl is None or ttl < answer_ttl:
+                    answer_ttl = ttl
+            elif i < ancount + nscount and rtype == DNS_TYPE_SOA:
+                # the SOA's own TTL, or its MINIMUM field, whichever is less
+                p = _dns_skip_name(pkt, _dns_skip_name(pkt, rdata))
+                (minimum,) = struct.unpack('!I', pkt[p+16:p+20])
+                negative_ttl = min(ttl, minimum)
+        pos = rdata + rdlen
+    if rcode == 0 and answer_ttl is not None:
+        return (min(answer_ttl, DNS_MAX_TTL), offsets)
+    elif rcode in (0, 3) and not ancount and negative_ttl is not None:
+        return (min(negative_ttl, DNS_MAX_NEGATIVE_TTL), offsets)
+    else:
+        return (0, [])  # SERVFAIL and friends, or no SOA to go by
+
+
+def _dns_same_question(request, qend, response):
+    # whether response's question section is the one in request[12:qend],
+    # give or take the case of the name
+    if len(response) < qend or response[4:6] != '\0\1':
+        return False
+    nend = qend - 4
+    return (response[12:nend].lower() == request[12:nend].lower()
+            and response[nend:qend] == request[nend:qend])
+
+
+def dns_answer(request, qend, response, offsets=(), age=0):
+    # Returns response rewritten as the answer to request, which asked the
+    # same question: the requester's transaction ID, the question spelled
+    # exactly the way they asked it (in case they randomize the case of the
+    # name), and the TTLs at offsets counted down by age seconds.  Some
+    # error replies leave the question out; those only get the new ID.
+    out = bytearray(response)
+    out[0:2] = request[0:2]
+    if _dns_same_question(request, qend, response):
+        out[12:qend] = request[12:qend]
+    if age:
+        for pos in offsets:
+            (ttl,) = struct.unpack_from('!I', out, pos)
+            struct.pack_into('!I', out, pos, max(ttl - age, 0))
+    return str(out)
+
+
+class DnsCache:
+    def __init__(self, size=DNS_CACHE_SIZE):
+        self.size = size
+        # key -> (expiry time, time stored, response, TTL offsets), oldest
+        # first
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, request):
+        # Returns the cached response to request, rewritten for whoever
+        # asked it this time, or None.
+        q = dns_question(request)
+        if not q:
+            return None
+        (qid, key, qend) = q
+        entry = self.entries.pop(key, None)
+        now = time.time()
+        if not entry or entry[0] <= now:
+            self.misses += 1
+            return None
+        self.entries[key] = entry  # now the most recently used
+        self.hits += 1
+        (expires, stored, response, offsets) = entry
+        return dns_answer(request, qend, response, offsets, int(now - stored))
+
+    def put(self, request, response):
+        q = dns_question(request)
+        if not q:
+            return
+        (qid, key, qend) = q
+        # only if it really answers that question
+        if not _dns_same_question(request, qend, response):
+            return
+        try:
+            (ttl, offsets) = dns_ttl(response)
+        except (IndexError, ValueError, struct.error):
+            return
+        if ttl <= 0:
+            return
+        now = time.time()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + ttl, now, response, offsets)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
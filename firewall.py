@@ -1,7 +1,8 @@
 import re, errno, socket, select, signal, struct, time
 import compat.ssubprocess as ssubprocess
-import helpers, ssyslog, ipaddr
+import helpers, ssyslog, ssnet
 from helpers import *
+from prefixtable import PrefixTable
 
 # python doesn't have a definition for these
 if 'IPPROTO_DIVERT' not in socket.__dict__:
@@ -22,6 +23,9 @@ def nonfatal(func, *args):
         log('error: %s\n' % e)
 
 def _call(argv):
+    if dry_run:
+        sys.stdout.write('# %s\n' % ' '.join(argv))
+        return 0
     debug1('>> %s\n' % ' '.join(argv))
     rv = ssubprocess.call(argv)
     if rv:
@@ -45,59 +49,222 @@ def get_external_ip():
             return i
     return '127.0.0.1'
 
-def ipt_chain_exists(name, table='nat'):
-    argv = ['iptables', '-t', table, '-nL']
+# With dry_run set, we print the commands and iptables-restore input we
+# would have used instead of touching the system, and keep track of the
+# chains and jumps we would have made in _dry_run_tables.  Handy for
+# testing without root.
+dry_run = False
+_dry_run_tables = {}  # table -> (chains, rules)
+
+def ipt_save(table):
+    # returns (chains, rules): the chain names in table and its rules, as
+    # iptables-save prints them
+    if dry_run:
+        (chains, rules) = _dry_run_tables.get(table, ([], []))
+        return (list(chains), list(rules))
+    argv = ['iptables-save', '-t', table]
     p = ssubprocess.Popen(argv, stdout = ssubprocess.PIPE)
+    chains = []
+    rules = []
     for line in p.stdout:
-        if line.startswith('Chain %s ' % name):
-            return True
+        if line.startswith(':'):
+            chains.append(line[1:].split()[0])
+        elif line.startswith('-A '):
+            rules.append(line.strip())
     rv = p.wait()
     if rv:
         raise Fatal('%r returned %d' % (argv, rv))
+    return (chains, rules)
+
+def ipt_restore(tables):
+    # Applies all the changes at once.  tables is a list of (table, lines),
+    # where each line is the arguments of one iptables command.  With
+    # --noflush, whatever we don't mention is left alone, and either all of
+    # it works or none of it does.
+    script = ''.join('*%s\n%sCOMMIT\n'
+                     % (table, ''.join(' '.join(l) + '\n' for l in lines))
+                     for table,lines in tables)
+    argv = ['iptables-restore', '--noflush']
+    if dry_run:
+        sys.stdout.write('# %s\n%s' % (' '.join(argv), script))
+        for table,lines in tables:
+            (chains, rules) = _dry_run_tables.setdefault(table, ([], []))
+            for l in lines:
+                _dry_run_ipt(chains, rules, l)
+        return
+    debug1('>> %s (%d rules)\n'
+           % (' '.join(argv), sum(len(lines) for t,lines in tables)))
+    debug2(script)
+    p = ssubprocess.Popen(argv, stdin = ssubprocess.PIPE)
+    p.communicate(script)
+    if p.returncode:
+        raise Fatal('%r returned %d' % (argv, p.returncode))
+
+def _dry_run_ipt(chains, rules, l):
+    # what iptables would do with the command l, to rules in the order (and
+    # the format) iptables-save would show them
+    mine = [i for i,r in enumerate(rules) if r.split()[1] == l[1]]
+    if l[0] == '-N':
+        chains.append(l[1])
+    elif l[0] == '-X':
+        chains.remove(l[1])
+    elif l[0] == '-F':
+        rules[:] = [r for r in rules if r.split()[1] != l[1]]
+    elif l[0] == '-A':
+        rules.append(' '.join(l))
+    elif l[0] == '-I':
+        pos = int(l[2])
+        if pos > len(mine) + 1:
+            raise Fatal('%r: index of insertion too big' % ' '.join(l))
+        rule = ' '.join(['-A', l[1]] + l[3:])
+        if pos <= len(mine):
+            rules.insert(mine[pos-1], rule)
+        else:
+            rules.append(rule)
+    elif l[0] == '-D':
+        rule = ' '.join(['-A'] + l[1:])
+        if rule not in rules:
+            raise Fatal('%r: no such rule' % ' '.join(l))
+        rules.remove(rule)
 
 def _ip(*args):
     argv = ['ip'] + list(args)
     _call(argv)
 
-def ipt(*args):
-    argv = ['iptables', '-t', 'nat'] + list(args)
-    _call(argv)
-
-def ipt_mangle(*args):
-    argv = ['iptables', '-t', 'mangle'] + list(args)
-    _call(argv)
-
+# With this many subnets or more, we put them in an ipset instead of giving
+# each one its own rule, so the kernel does one hash lookup per prefix
+# length instead of walking every rule for every new connection.  Excludes
+# go in the same set, flagged nomatch: the set answers with its most
+# specific matching entry, so that's the same longest-prefix-wins (and
+# excludes-win-ties) behaviour as our sorted rules.
+IPSET_MIN_SUBNETS = 16
+_dry_run_sets = []
+_no_ipset = False  # the ipset program is there, but the kernel can't do it
+
+def ipset_exists(name):
+    if dry_run:
+        return name in _dry_run_sets
+    if not program_exists('ipset'):
+        return False
+    argv = ['ipset', 'list', '-n']
+    p = ssubprocess.Popen(argv, stdout = ssubprocess.PIPE)
+    found = False
+    for line in p.stdout:
+        if line.strip() == name:
+            found = True
+    rv = p.wait()
+    if rv:
+        # eg. no ip_set support in this kernel (or container); then there
+        # can't be a set of ours either.
+        debug1('%r returned %d\n' % (argv, rv))
+        return False
+    return found
 
+def ipset_nets(subnets):
+    # (width, net) -> whether it's an exclude
+    nets = {}
+    for swidth,sexclude,snet in subnets:
+        if swidth == 0:
+            # hash:net can't hold a /0, but two /1s do the same job
+            halves = [(1, '0.0.0.0'), (1, '128.0.0.0')]
+        else:
+            halves = [(swidth, snet)]
+        for net in halves:
+            nets[net] = nets.get(net) or sexclude
+    return nets
+
+def ipset_entry(name, (swidth,snet), sexclude):
+    return 'add %s %s/%d%s' % (name, snet, swidth,
+                               sexclude and ' nomatch' or '')
+
+def ipset_load(name, subnets):
+    nets = ipset_nets(subnets)
+    lines = ['create %s hash:net family inet maxelem %d -exist'
+             % (name, max(65536, 2*len(nets))),
+             'flush %s' % name]
+    for net,sexclude in sorted(nets.items(), key=lambda i:
+                               (i[0][0], socket.inet_aton(i[0][1]))):
+        lines.append(ipset_entry(name, net, sexclude))
+    if dry_run and name not in _dry_run_sets:
+        _dry_run_sets.append(name)
+    ipset_restore(lines)
+
+def ipset_update(name, old, new):
+    onets = ipset_nets(old)
+    nnets = ipset_nets(new)
+    lines = []
+    for (swidth,snet),sexclude in onets.items():
+        if nnets.get((swidth,snet)) != sexclude:
+            lines.append('del %s %s/%d' % (name, snet, swidth))
+    for net,sexclude in nnets.items():
+        if onets.get(net) != sexclude:
+            lines.append(ipset_entry(name, net, sexclude))
+    if lines:
+        ipset_restore(lines)
+
+def ipset_restore(lines):
+    script = ''.join(l + '\n' for l in lines)
+    argv = ['ipset', 'restore']
+    if dry_run:
+        sys.stdout.write('# %s\n%s' % (' '.join(argv), script))
+        return
+    debug1('>> %s (%d lines)\n' % (' '.join(argv), len(lines)))
+    p = ssubprocess.Popen(argv, stdin = ssubprocess.PIPE)
+    p.communicate(script)
+    if p.returncode:
+        raise Fatal('%r returned %d' % (argv, p.returncode))
+
+def ipset_destroy(name):
+    if dry_run:
+        _dry_run_sets.remove(name)
+    _call(['ipset', 'destroy', name])
+
+def ipt_cleanup(chain, table, hooks):
+    # the commands that unhook and delete chain from table, if it's there
+    (chains, rules) = ipt_save(table)
+    if chain not in chains:
+        return []
+    lines = []
+    for hook in hooks:
+        rule = '-A %s -j %s' % (hook, chain)
+        for i in range(rules.count(rule)):
+            lines.append(['-D', hook, '-j', chain])
+    lines.append(['-F', chain])
+    lines.append(['-X', chain])
+    return lines
+
+
+# we avoid infinite loops by generating server-side connections with ttl 42.
+# This makes the client side not recapture those connections, in case
+# client == server.
+TTL_MATCH = ['-m', 'ttl', '!', '--ttl', '42']
 _no_ttl_module = False
-def ipt_ttl(*args):
-    global _no_ttl_module
-    if not _no_ttl_module:
-        # we avoid infinite loops by generating server-side connections
-        # with ttl 42.  This makes the client side not recapture those
-        # connections, in case client == server.
-        try:
-            argsplus = list(args) + ['-m', 'ttl', '!', '--ttl', '42']
-            ipt(*argsplus)
-        except Fatal:
-            ipt(*args)
-            # we only get here if the non-ttl attempt succeeds
-            log('sshuttle: warning: your iptables is missing '
-                'the ttl module.\n')
-            _no_ttl_module = True
-    else:
-        ipt(*args)
+def ipt_ttl(args):
+    if _no_ttl_module:
+        return args
+    return args + TTL_MATCH
 
 udp_replay_sockets = {} # Dictionary mapping tuples (remote, remote_port) to lists [sock, timeout]
 udp_replay_timeout = 5
-def replay_udp(sock):
-    udp_length, source, source_port, remote, remote_port = struct.unpack('!H4sH4sH', sock.recv(14))
-    udp_data = sock.recv(udp_length)
+udp_timers = ssnet.Timers()
+def expire_replay_socket(replay_key):
+    s = udp_replay_sockets.pop(replay_key)
+    try:
+        s[0].close()
+    except:
+        pass
+
+def replay_udp(packet):
+    source, source_port, remote, remote_port = struct.unpack('!4sH4sH', packet[:12])
+    udp_data = packet[12:]
     replay_key = remote, remote_port
     if replay_key not in udp_replay_sockets:
         boundSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         boundSock.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
         boundSock.bind((socket.inet_ntoa(remote), remote_port))
-        udp_replay_sockets[replay_key] = [boundSock, 0]
+        s = udp_replay_sockets[replay_key] = [boundSock, 0]
+        udp_timers.add_deadline(lambda: s[1],
+                                lambda: expire_replay_socket(replay_key))
     if source == '\x00\x00\x00\x00':
         source = get_external_ip()
     else:
@@ -108,13 +275,68 @@ def replay_udp(sock):
         udp_replay_sockets[replay_key][1] = now + udp_replay_timeout
     except socket.error:
         pass
-    for r, s in udp_replay_sockets.items():
-        if s[1] < now:
-            try:
-                s[0].close()
-            except:
-                pass
-            del udp_replay_sockets[r]
+
+# UDP to our own addresses mustn't get diverted, unless they're explicitly
+# excluded anyway.
+def udp_local_ips(subnets):
+    excludes = PrefixTable([(snet, swidth, True)
+                            for swidth,sexclude,snet in subnets if sexclude])
+    return [ip for ip in get_local_ips() if ip not in excludes]
+
+# Once the UDP rules are in, we pick up the datagrams they divert to
+# udpport with a raw socket and pass them to the client, and send the
+# client's replies back out from the right address; until stdin has
+# something to say.
+def udp_relay(udpport):
+    log('Establishing UDP sockets...\n')
+    try:
+        rawsock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+        rawsock.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
+        rawsock.bind(('', udpport))
+        rawsock.setblocking(False)
+    except socket.error, e:
+        raise Fatal('Could not set up listening UDP sockets! %r\n' % e)
+    try:
+        # Connection back to the client
+        clientudp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        clientudp.connect(('127.0.0.1', udpport))
+    except socket.error, e:
+        raise Fatal('Could not set up UDP socket back to client! %r\n' % e)
+    stream = ssnet.DatagramStream(clientudp)
+    socks = [sys.stdin, rawsock, clientudp]
+    def do_wait():
+        while True:
+            if clientudp in socks and stream.has_output():
+                w = [clientudp]
+            else:
+                w = []
+            r, w, x = select.select(socks, w, [], udp_timers.timeout())
+            if rawsock in r:
+                for i in xrange(ssnet.DGRAM_BATCH):
+                    try:
+                        stream.queue(rawsock.recv(65536))
+                    except socket.error, e:
+                        if e.args[0] not in (errno.EWOULDBLOCK,
+                                             errno.EAGAIN):
+                            raise
+                        break
+            if rawsock in r or clientudp in w:
+                try:
+                    stream.flush()
+                except socket.error:
+                    socks[1:] = []  # the client is going away
+            if clientudp in r:
+                for packet in stream.read():
+                    replay_udp(packet)
+                if not stream.ok:
+                    # the client is going away; we'll hear about
+                    # it on stdin soon enough.
+                    socks[1:] = []
+            if sys.stdin in r:
+                return
+            udp_timers.run()
+    return do_wait
+
 
 # We name the chain based on the transproxy port number so that it's possible
 # to run multiple copies of sshuttle at the same time.  Of course, the
@@ -122,42 +344,28 @@ def replay_udp(sock):
 # recently-started one will win (because we use "-I OUTPUT 1" instead of
 # "-A OUTPUT").
 def do_iptables(port, dnsport, udpport, subnets):
-    chain = 'sshuttle-%s' % port
-    fwmark = hex(udpport)
+    ipt_setup(port, dnsport, udpport, subnets)
+    if subnets and udpport and not dry_run:
+        return udp_relay(udpport)
 
-    # basic cleanup/setup of chains
-    if ipt_chain_exists(chain):
-        nonfatal(ipt, '-D', 'OUTPUT', '-j', chain)
-        nonfatal(ipt, '-D', 'PREROUTING', '-j', chain)
-        nonfatal(ipt, '-F', chain)
-        ipt('-X', chain)
-    if udpport and ipt_chain_exists(chain, table='mangle'):
-        nonfatal(ipt_mangle, '-D', 'OUTPUT', '-j', chain)
-        nonfatal(ipt_mangle, '-F', chain)
-        ipt_mangle('-X', chain)
-        nonfatal(_ip, 'rule', 'del', 'fwmark', fwmark, 'lookup', str(udpport))
-        nonfatal(_ip, 'route', 'del', 'local', '0.0.0.0/0', 'dev', 'lo', 'table', str(udpport))
+def ipt_use_ipset(subnets):
+    return (len(subnets) >= IPSET_MIN_SUBNETS and not _no_ipset
+            and (dry_run or program_exists('ipset')))
 
-    if subnets or dnsport:
-        ipt('-N', chain)
-        ipt('-F', chain)
-        ipt('-I', 'OUTPUT', '1', '-j', chain)
-        ipt('-I', 'PREROUTING', '1', '-j', chain)
-        if udpport:
-            ipt_mangle('-N', chain)
-            ipt_mangle('-F', chain)
-            ipt_mangle('-I', 'OUTPUT', '1', '-j', chain)
-            _ip('rule', 'add', 'fwmark', fwmark, 'lookup', str(udpport))
-            _ip('route', 'add', 'local', '0.0.0.0/0', 'dev', 'lo', 'table', str(udpport))
+def ipt_rules(chain, port, dnsport, udpport, subnets, use_ipset):
+    # returns (nat_rules, mangle_rules), the contents of our chains
+    fwmark = hex(udpport)
+    nat_rules = []
+    mangle_rules = []
 
     if dnsport:
         nslist = resolvconf_nameservers()
         for ip in nslist:
-            ipt_ttl('-A', chain, '-j', 'REDIRECT',
-                    '--dest', '%s/32' % ip,
-                    '-p', 'udp',
-                    '--dport', '53',
-                    '--to-ports', str(dnsport))
+            nat_rules.append(ipt_ttl(['-A', chain, '-j', 'REDIRECT',
+                              '--dest', '%s/32' % ip,
+                              '-p', 'udp',
+                              '--dport', '53',
+                              '--to-ports', str(dnsport)]))
 
     if subnets:
         # create new subnet entries.  Note that we're sorting in a very
@@ -165,60 +373,304 @@ def do_iptables(port, dnsport, udpport, subnets):
         # to least-specific, and at any given level of specificity, we want
         # excludes to come first.  That's why the columns are in such a non-
         # intuitive order.
+        if use_ipset:
+            nat_rules.append(ipt_ttl(['-A', chain, '-p', 'tcp',
+                                      '-m', 'set', '--match-set', chain, 'dst',
+                                      '-j', 'REDIRECT',
+                                      '--to-ports', str(port)]))
+        for swidth,sexclude,snet in not use_ipset and sorted(subnets, reverse=True) or []:
+            if sexclude:
+                nat_rules.append(['-A', chain, '-j', 'RETURN',
+                                  '--dest', '%s/%s' % (snet,swidth),
+                                  '-p', 'tcp'])
+            else:
+                nat_rules.append(ipt_ttl(['-A', chain, '-j', 'REDIRECT',
+                                  '--dest', '%s/%s' % (snet,swidth),
+                                  '-p', 'tcp',
+                                  '--to-ports', str(port)]))
+        if udpport:
+            for local_ip in udp_local_ips(subnets):
+                mangle_rules.append(['-A', chain, '-j', 'RETURN',
+                                     '--dest', '%s/32' % local_ip,
+                                     '-p', 'udp'])
+            if use_ipset:
+                mangle_rules.append(['-A', chain, '-p', 'udp',
+                                     '-m', 'set', '--match-set', chain, 'dst',
+                                     '!', '--dport', '53',
+                                     '-j', 'MARK', '--set-mark', fwmark])
+            for swidth,sexclude,snet in not use_ipset and sorted(subnets, reverse=True) or []:
+                if sexclude:
+                    mangle_rules.append(['-A', chain, '-j', 'RETURN',
+                                         '--dest', '%s/%s' % (snet,swidth),
+                                         '-p', 'udp'])
+                else:
+                    mangle_rules.append(['-A', chain, '-p', 'udp',
+                                         '--dest', '%s/%s' % (snet,swidth),
+                                         '!', '--dport', '53',
+                                         '-j', 'MARK', '--set-mark', fwmark])
+    return (nat_rules, mangle_rules)
+
+def ipt_setup(port, dnsport, udpport, subnets):
+    global _no_ipset
+    chain = 'sshuttle-%s' % port
+    fwmark = hex(udpport)
+
+    # basic cleanup/setup of chains
+    nat = ipt_cleanup(chain, 'nat', ['OUTPUT', 'PREROUTING'])
+    mangle = []
+    if udpport:
+        mangle = ipt_cleanup(chain, 'mangle', ['OUTPUT'])
+        if mangle:
+            nonfatal(_ip, 'rule', 'del', 'fwmark', fwmark, 'lookup', str(udpport))
+            nonfatal(_ip, 'route', 'del', 'local', '0.0.0.0/0', 'dev', 'lo', 'table', str(udpport))
+    use_ipset = ipt_use_ipset(subnets)
+    if use_ipset:
+        try:
+            ipset_load(chain, subnets)
+            ipt_install(chain, port, dnsport, udpport, subnets, True,
+                        nat, mangle)
+        except Fatal, e:
+            # Having the ipset program doesn't mean the kernel has ip_set
+            # and xt_set (containers often don't).  Nothing got changed,
+            # so just do it the old way.
+            log('sshuttle: warning: ipset isn\'t working (%s); '
+                'using one rule per subnet.\n' % e)
+            _no_ipset = True
+            use_ipset = False
+    if not use_ipset:
+        ipt_install(chain, port, dnsport, udpport, subnets, False,
+                    nat, mangle)
+        if ipset_exists(chain):
+            # left over from before; nothing refers to it any more
+            nonfatal(ipset_destroy, chain)
+
+    if udpport and (subnets or dnsport):
+        _ip('rule', 'add', 'fwmark', fwmark, 'lookup', str(udpport))
+        _ip('route', 'add', 'local', '0.0.0.0/0', 'dev', 'lo', 'table', str(udpport))
+
+# chain -> (use_ipset, nat_rules, mangle_rules): what's in our chains right
+# now, so route changes can be worked out against what's really there.
+_ipt_installed = {}
+
+def ipt_install(chain, port, dnsport, udpport, subnets, use_ipset,
+                nat, mangle):
+    # nat and mangle are the commands that clean up after last time
+    global _no_ttl_module
+    (nat_rules, mangle_rules) = ipt_rules(chain, port, dnsport, udpport,
+                                          subnets, use_ipset)
+    nat_head = mangle_head = []
+    if subnets or dnsport:
+        nat_head = [['-N', chain],
+                    ['-I', 'OUTPUT', '1', '-j', chain],
+                    ['-I', 'PREROUTING', '1', '-j', chain]]
+        if udpport:
+            mangle_head = [['-N', chain],
+                           ['-I', 'OUTPUT', '1', '-j', chain]]
+
+    # The whole thing, cleanup included, goes in as one iptables-restore
+    # transaction, instead of forking iptables once (or twice) per rule.
+    tables = []
+    if nat or nat_head:
+        tables.append(('nat', nat + nat_head + nat_rules))
+    if mangle or mangle_head:
+        tables.append(('mangle', mangle + mangle_head + mangle_rules))
+    if tables:
+        n = len(TTL_MATCH)
+        try:
+            ipt_restore(tables)
+        except Fatal:
+            if not [r for r in nat_rules if r[-n:] == TTL_MATCH]:
+                raise
+            # maybe it's just the ttl module that's missing
+            nat_rules = [r[-n:] == TTL_MATCH and r[:-n] or r
+                         for r in nat_rules]
+            tables[0] = ('nat', nat + nat_head + nat_rules)
+            ipt_restore(tables)
+            # we only get here if the non-ttl attempt succeeds
+            log('sshuttle: warning: your iptables is missing '
+                'the ttl module.\n')
+            _no_ttl_module = True
+    _ipt_installed[chain] = (use_ipset, nat_rules, mangle_rules)
+
+def ipt_diff(chain, old, new):
+    # the commands that turn chain's old rules into the new ones, without
+    # touching the rules they have in common.  Both lists are in the same
+    # order, so once the old rules are gone, inserting each new rule at its
+    # final position puts everything in the right place.
+    lines = []
+    keep = set(tuple(r) for r in new)
+    have = set(tuple(r) for r in old)
+    for r in old:
+        if tuple(r) not in keep:
+            lines.append(['-D'] + r[1:])
+    for i,r in enumerate(new):
+        if tuple(r) not in have:
+            lines.append(['-I', chain, str(i+1)] + r[2:])
+    return lines
+
+def update_iptables(port, dnsport, udpport, old, new):
+    chain = 'sshuttle-%s' % port
+    use_ipset = ipt_use_ipset(new)
+    installed = _ipt_installed.get(chain)
+    if (not installed or use_ipset != installed[0]
+          or not (old or dnsport) or not (new or dnsport)):
+        # the chains themselves come or go; start over
+        ipt_setup(port, dnsport, udpport, new)
+        return
+    (ipset, onat, omangle) = installed
+    (nnat, nmangle) = ipt_rules(chain, port, dnsport, udpport, new, use_ipset)
+    tables = []
+    for table,o,n in [('nat', onat, nnat), ('mangle', omangle, nmangle)]:
+        lines = ipt_diff(chain, o, n)
+        if lines:
+            tables.append((table, lines))
+    # The set and the chains can't change in one transaction, so if the
+    # chains won't go in, put the set back the way it was; either way, the
+    # caller's idea of our rules stays true.
+    if use_ipset:
+        ipset_update(chain, old, new)
+    if tables:
+        try:
+            ipt_restore(tables)
+        except Fatal:
+            if use_ipset:
+                ipset_update(chain, new, old)
+            raise
+    _ipt_installed[chain] = (use_ipset, nnat, nmangle)
+
+_dry_run_nft_tables = []
+
+def nft_table_exists(table):
+    if dry_run:
+        return table in _dry_run_nft_tables
+    argv = ['nft', 'list', 'tables', 'ip']
+    p = ssubprocess.Popen(argv, stdout = ssubprocess.PIPE)
+    found = False
+    for line in p.stdout:
+        if line.split() == ['table', 'ip', table]:
+            found = True
+    rv = p.wait()
+    if rv:
+        raise Fatal('%r returned %d' % (argv, rv))
+    return found
+
+def nft(script):
+    argv = ['nft', '-f', '-']
+    if dry_run:
+        sys.stdout.write('# %s\n%s' % (' '.join(argv), script))
+        return
+    debug1('>> %s\n' % ' '.join(argv))
+    debug2(script)
+    p = ssubprocess.Popen(argv, stdin = ssubprocess.PIPE)
+    p.communicate(script)
+    if p.returncode:
+        raise Fatal('%r returned %d' % (argv, p.returncode))
+
+# Like do_iptables, but with a table of our own, so setting up or tearing
+# down is always a single atomic nft transaction: (re)create the table and
+# everything in it, or just delete it.  nft matches the ttl by itself, with
+# no module to go missing.
+def do_nftables(port, dnsport, udpport, subnets):
+    nft_setup(port, dnsport, udpport, subnets)
+    if subnets and udpport and not dry_run:
+        return udp_relay(udpport)
+
+def nft_rules(port, dnsport, udpport, subnets):
+    # returns (rules, udp_rules), the contents of our two chains
+    fwmark = hex(udpport)
+    rules = []
+    udp_rules = []
+
+    if dnsport:
+        for ip in resolvconf_nameservers():
+            rules.append('ip daddr %s udp dport 53 ip ttl != 42 '
+                         'redirect to :%d' % (ip, dnsport))
+
+    if subnets:
+        # same order as do_iptables: most specific first, excludes first
         for swidth,sexclude,snet in sorted(subnets, reverse=True):
             if sexclude:
-                ipt('-A', chain, '-j', 'RETURN',
-                    '--dest', '%s/%s' % (snet,swidth),
-                    '-p', 'tcp')
+                rules.append('ip daddr %s/%d meta l4proto tcp return'
+                             % (snet, swidth))
             else:
-                ipt_ttl('-A', chain, '-j', 'REDIRECT',
-                        '--dest', '%s/%s' % (snet,swidth),
-                        '-p', 'tcp',
-                        '--to-ports', str(port))
+                rules.append('ip daddr %s/%d meta l4proto tcp ip ttl != 42 '
+                             'redirect to :%d' % (snet, swidth, port))
         if udpport:
-            for local_ip in get_local_ips():
-                excluded = False
-                ip_address = ipaddr.IPAddress(local_ip)
-                for swidth,sexclude,snet in subnets:
-                    if sexclude and ip_address in ipaddr.IPNetwork('%s/%s' % (snet,swidth)):
-                        excluded = True
-                if not excluded:
-                    ipt_mangle('-A', chain, '-j', 'RETURN',
-                               '--dest', '%s/32' % local_ip,
-                               '-p', 'udp')
+            for local_ip in udp_local_ips(subnets):
+                udp_rules.append('ip daddr %s meta l4proto udp return'
+                                 % local_ip)
             for swidth,sexclude,snet in sorted(subnets, reverse=True):
                 if sexclude:
-                    ipt_mangle('-A', chain, '-j', 'RETURN',
-                               '--dest', '%s/%s' % (snet,swidth),
-                               '-p', 'udp')
+                    udp_rules.append('ip daddr %s/%d meta l4proto udp return'
+                                     % (snet, swidth))
                 else:
-                    ipt_mangle('-A', chain, '-p', 'udp',
-                               '--dest', '%s/%s' % (snet,swidth),
-                               '!', '--dport', '53',
-                               '-j', 'MARK', '--set-mark', fwmark)
-            log('Establishing UDP sockets...\n')
-            try:
-                rawsock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
-                rawsock.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
-                rawsock.bind(('', udpport))
-            except socket.error, e:
-                raise Fatal('Could not set up listening UDP sockets! %r\n' % e)
-            try:
-                # Connection back to the client
-                clientudp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                clientudp.connect(('127.0.0.1', udpport))
-            except socket.error, e:
-                raise Fatal('Could not set up UDP socket back to client! %r\n' % e)
-            def do_wait():
-                while True:
-                    r, w, x = select.select([sys.stdin, rawsock, clientudp], [], [])
-                    if rawsock in r:
-                        clientudp.send(rawsock.recv(131072))
-                    if clientudp in r:
-                        replay_udp(clientudp)
-                    if sys.stdin in r:
-                        return
-            return do_wait
+                    udp_rules.append('ip daddr %s/%d udp dport != 53 '
+                                     'meta mark set %s'
+                                     % (snet, swidth, fwmark))
+    return (rules, udp_rules)
+
+def nft_setup(port, dnsport, udpport, subnets):
+    table = 'sshuttle-%s' % port
+    fwmark = hex(udpport)
+
+    if udpport and nft_table_exists(table):
+        nonfatal(_ip, 'rule', 'del', 'fwmark', fwmark, 'lookup', str(udpport))
+        nonfatal(_ip, 'route', 'del', 'local', '0.0.0.0/0', 'dev', 'lo', 'table', str(udpport))
+
+    # declaring the table first means deleting it can't fail
+    lines = ['table ip %s {}' % table,
+             'delete table ip %s' % table]
+    (rules, udp_rules) = nft_rules(port, dnsport, udpport, subnets)
+
+    if rules or udp_rules:
+        lines.append('table ip %s {' % table)
+        lines.append('  chain sshuttle {')
+        lines += ['    %s' % r for r in rules]
+        lines.append('  }')
+        for hook in ('output', 'prerouting'):
+            lines.append('  chain nat_%s {' % hook)
+            lines.append('    type nat hook %s priority -100; policy accept;'
+                         % hook)
+            lines.append('    jump sshuttle')
+            lines.append('  }')
+        if udp_rules:
+            lines.append('  chain udp_output {')
+            lines.append('    type route hook output priority -150; '
+                         'policy accept;')
+            lines += ['    %s' % r for r in udp_rules]
+            lines.append('  }')
+        lines.append('}')
+    nft(''.join(l + '\n' for l in lines))
+    if dry_run:
+        if table in _dry_run_nft_tables:
+            _dry_run_nft_tables.remove(table)
+        if rules or udp_rules:
+            _dry_run_nft_tables.append(table)
+
+    if udp_rules:
+        _ip('rule', 'add', 'fwmark', fwmark, 'lookup', str(udpport))
+        _ip('route', 'add', 'local', '0.0.0.0/0', 'dev', 'lo', 'table', str(udpport))
+
+def update_nftables(port, dnsport, udpport, old, new):
+    # nft can only delete a rule by its handle, so instead we refill just
+    # the chains that changed, in one transaction.  Packets never see a
+    # half-updated chain, and connections that are already going stay as
+    # they are, since NAT only looks at a connection's first packet.
+    table = 'sshuttle-%s' % port
+    (orules, oudp) = nft_rules(port, dnsport, udpport, old)
+    (nrules, nudp) = nft_rules(port, dnsport, udpport, new)
+    if not orules or not nrules or bool(oudp) != bool(nudp):
+        # the chains themselves come or go; start over
+        nft_setup(port, dnsport, udpport, new)
+        return
+    lines = []
+    for chain,o,n in [('sshuttle', orules, nrules), ('udp_output', oudp, nudp)]:
+        if o != n:
+            lines.append('flush chain ip %s %s' % (table, chain))
+            lines += ['add rule ip %s %s %s' % (table, chain, r) for r in n]
+    if lines:
+        nft(''.join(l + '\n' for l in lines))
+
 
 def ipfw_rule_exists(n):
     argv = ['ipfw', 'list']
@@ -360,7 +812,7 @@ def ipfw(*args):
     _call(argv)
 
 
-def do_ipfw(port, dnsport, subnets):
+def do_ipfw(port, dnsport, udpport, subnets):
     sport = str(port)
     xsport = str(port+1)
 
@@ -535,6 +987,66 @@ def restore_etc_hosts(port):
     rewrite_etc_hosts(port)
 
 
+# The smallest list of rules that forwards exactly what the given subnets
+# do.  The longest matching prefix decides what happens to an address, and
+# an exclude beats an include of the same subnet, so: sibling halves that
+# do the same thing become their parent (which they override anyway), and
+# anything that does the same as the next shorter prefix covering it goes
+# away, as do excludes that don't carve anything out of an include.
+def collapse_subnets(subnets):
+    # whether each prefix is an exclude
+    nets = PrefixTable()
+    for swidth,sexclude,snet in subnets:
+        nets.add(snet, swidth, nets.get(snet, swidth) or bool(sexclude))
+    for width in range(32, 0, -1):
+        d = nets.nets.get(width, {})
+        for ip in d.keys():
+            if ip not in d:
+                continue  # merged with its sibling already
+            sibling = ip ^ (1L << (32-width))
+            if sibling in d and d[sibling] == d[ip]:
+                nets.remove(sibling, width)
+                nets.add(ip, width-1, nets.remove(ip, width))
+    rules = []
+    for ((w,ip),exclude) in nets.items():
+        covering = nets.match(ip, w)
+        if covering is None and not exclude \
+          or covering is not None and covering[1] != exclude:
+            rules.append((w, exclude, socket.inet_ntoa(struct.pack('!I', ip))))
+    rules.sort(reverse=True)
+    return rules
+
+def collapse_routes(subnets):
+    rules = collapse_subnets(subnets)
+    if len(rules) < len(subnets):
+        debug1('firewall manager: %d subnets collapse into %d rules '
+               '(%d saved).\n' % (len(subnets), len(rules),
+                                   len(subnets) - len(rules)))
+    return rules
+
+# For --dry-run: shows what we'd do to set up the firewall for subnets, and
+# then to undo it again, without touching anything.
+def show(port, dnsport, udpport, subnets, method='auto'):
+    global dry_run
+    dry_run = True
+    if method == 'nft':
+        do_it = do_nftables
+    elif method == 'ipfw':
+        raise Fatal('--dry-run only works with iptables or nft')
+    else:
+        do_it = do_iptables
+    do_it(port, dnsport, udpport, collapse_routes(subnets))
+    do_it(port, 0, udpport, [])
+
+
+def parse_route(line):
+    try:
+        (width,exclude,ip) = line.strip().split(',', 2)
+        return (int(width), bool(int(exclude)), ip)
+    except ValueError:
+        raise Fatal('firewall: expected route or GO but got %r' % line)
+
+
 # This is some voodoo for setting up the kernel's transparent
 # proxying stuff.  If subnets is empty, we just delete our sshuttle rules;
 # otherwise we delete it, then make them from scratch.
@@ -543,7 +1055,11 @@ def restore_etc_hosts(port):
 # exit.  In case that fails, it's not the end of the world; future runs will
 # supercede it in the transproxy list, at least, so the leftover rules
 # are hopefully harmless.
-def main(port, dnsport, udpport, syslog):
+METHODS = {'ipfw': do_ipfw, 'iptables': do_iptables, 'nft': do_nftables}
+# how to change the routes of a running backend, given the old and new lists
+UPDATERS = {do_iptables: update_iptables, do_nftables: update_nftables}
+
+def main(port, dnsport, udpport, syslog, method='auto'):
     assert(port > 0)
     assert(port <= 65535)
     assert(dnsport >= 0)
@@ -555,12 +1071,18 @@ def main(port, dnsport, udpport, syslog):
     if os.getuid() != 0:
         raise Fatal('you must be root (or enable su/sudo) to set the firewall')
 
-    if program_exists('ipfw'):
+    if method != 'auto':
+        if not program_exists(method):
+            raise Fatal("can't find %s; check your PATH" % method)
+        do_it = METHODS[method]
+    elif program_exists('ipfw'):
         do_it = do_ipfw
     elif program_exists('iptables'):
         do_it = do_iptables
+    elif program_exists('nft'):
+        do_it = do_nftables
     else:
-        raise Fatal("can't find either ipfw or iptables; check your PATH")
+        raise Fatal("can't find ipfw, iptables or nft; check your PATH")
 
     # because of limitations of the 'su' command, the *real* stdin/stdout
     # are both attached to stdout initially.  Clone stdout into stdin so we
@@ -600,16 +1122,15 @@ def main(port, dnsport, udpport, syslog):
             raise Fatal('firewall: expected route but got %r' % line)
         elif line == 'GO\n':
             break
-        try:
-            (width,exclude,ip) = line.strip().split(',', 2)
-        except:
-            raise Fatal('firewall: expected route or GO but got %r' % line)
-        subnets.append((int(width), bool(int(exclude)), ip))
+        route = parse_route(line)
+        if route not in subnets:
+            subnets.append(route)
+    rules = collapse_routes(subnets)
 
     try:
         if line:
             debug1('firewall manager: starting transproxy.\n')
-            do_wait = do_it(port, dnsport, udpport, subnets)
+            do_wait = do_it(port, dnsport, udpport, rules)
             sys.stdout.write('STARTED\n')
 
         try:
@@ -629,6 +1150,46 @@ def main(port, dnsport, udpport, syslog):
                 (name,ip) = line[5:].strip().split(',', 1)
                 hostmap[name] = ip
                 rewrite_etc_hosts(port)
+            elif line.startswith('ADD_ROUTE ') or line.startswith('DEL_ROUTE '):
+                # a batch of changes, up to GO, applied all at once
+                new = list(subnets)
+                while line != 'GO\n':
+                    if line.startswith('ADD_ROUTE '):
+                        route = parse_route(line[10:])
+                        if route not in new:
+                            new.append(route)
+                    elif line.startswith('DEL_ROUTE '):
+                        route = parse_route(line[10:])
+                        if route in new:
+                            new.remove(route)
+                    else:
+                        raise Fatal('firewall: expected route change or GO '
+                                    'but got %r' % line)
+                    line = sys.stdin.readline(128)
+                # the client waits to hear whether it worked, so its idea
+                # of our routes stays the same as ours
+                update = UPDATERS.get(do_it)
+                try:
+                    if not update:
+                        raise Fatal('this firewall method can\'t change '
+                                    'routes while running')
+                    debug1('firewall manager: changing routes.\n')
+                    new_rules = collapse_routes(new)
+                    update(port, dnsport, udpport, rules, new_rules)
+                except Fatal, e:
+                    # the updaters leave the old rules in place when they
+                    # fail, so keep using them
+                    log('firewall manager: could not change routes: %s\n' % e)
+                    sys.stdout.write('ROUTES_FAILED %s\n'
+                                     % ' '.join(str(e).split()))
+                    sys.stdout.flush()
+                    continue
+                subnets = new
+                rules = new_rules
+                sys.stdout.write('ROUTES_OK\n')
+                sys.stdout.flush()
+                if rules and udpport and not do_wait:
+                    do_wait = udp_relay(udpport)
             elif line:
                 raise Fatal('expected EOF, got %r' % line)
             else:
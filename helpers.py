@@ -1,4 +1,4 @@
-import sys, os, socket, errno
+import sys, os, re, socket, errno
 
 logprefix = ''
 verbose = 0
@@ -13,16 +13,27 @@ def log(s):
         # our tty closes.  That sucks, but it's no reason to abort the program.
         pass
 
-def debug1(s):
+# The debug functions take their format arguments separately, like
+# debug2('%r: foo\n', self), so that nothing gets formatted (and no __repr__
+# gets called) unless the message is actually going to be printed.  In
+# per-packet code, even that call costs too much: check helpers.verbose
+# before calling instead.
+def debug1(s, *args):
     if verbose >= 1:
+        if args:
+            s = s % args
         log(s)
 
-def debug2(s):
+def debug2(s, *args):
     if verbose >= 2:
+        if args:
+            s = s % args
         log(s)
 
-def debug3(s):
+def debug3(s, *args):
     if verbose >= 3:
+        if args:
+            s = s % args
         log(s)
 
 
@@ -35,6 +46,28 @@ class FatalNeedsReboot(Fatal):
     pass
 
 
+# list of:
+# 1.2.3.4/5 or just 1.2.3.4
+def parse_subnets(subnets_str):
+    subnets = []
+    for s in subnets_str:
+        m = re.match(r'(\d+)(?:\.(\d+)\.(\d+)\.(\d+))?(?:/(\d+))?$', s)
+        if not m:
+            raise Fatal('%r is not a valid IP subnet format' % s)
+        (a,b,c,d,width) = m.groups()
+        (a,b,c,d) = (int(a or 0), int(b or 0), int(c or 0), int(d or 0))
+        if width == None:
+            width = 32
+        else:
+            width = int(width)
+        if a > 255 or b > 255 or c > 255 or d > 255:
+            raise Fatal('%d.%d.%d.%d has numbers > 255' % (a,b,c,d))
+        if width > 32:
+            raise Fatal('*/%d is greater than the maximum of 32' % width)
+        subnets.append(('%d.%d.%d.%d' % (a,b,c,d), width))
+    return subnets
+
+
 def list_contains_any(l, sub):
     for i in sub:
         if i in l:
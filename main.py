@@ -1,31 +1,9 @@
 import sys, os, re
-import helpers, options, client, server, firewall, hostwatch
+import helpers, options, client, server, firewall, hostwatch, ssnet
 import compat.ssubprocess as ssubprocess
 from helpers import *
 
 
-# list of:
-# 1.2.3.4/5 or just 1.2.3.4
-def parse_subnets(subnets_str):
-    subnets = []
-    for s in subnets_str:
-        m = re.match(r'(\d+)(?:\.(\d+)\.(\d+)\.(\d+))?(?:/(\d+))?$', s)
-        if not m:
-            raise Fatal('%r is not a valid IP subnet format' % s)
-        (a,b,c,d,width) = m.groups()
-        (a,b,c,d) = (int(a or 0), int(b or 0), int(c or 0), int(d or 0))
-        if width == None:
-            width = 32
-        else:
-            width = int(width)
-        if a > 255 or b > 255 or c > 255 or d > 255:
-            raise Fatal('%d.%d.%d.%d has numbers > 255' % (a,b,c,d))
-        if width > 32:
-            raise Fatal('*/%d is greater than the maximum of 32' % width)
-        subnets.append(('%d.%d.%d.%d' % (a,b,c,d), width))
-    return subnets
-
-
 # 1.2.3.4:567 or just 1.2.3.4 or just 567
 def parse_ipport(s):
     s = str(s)
@@ -48,6 +26,7 @@ optspec = """
 sshuttle [-l [ip:]port] [-r [username@]sshserver[:port]] <subnets...>
 sshuttle --server
 sshuttle --firewall <port> <subnets...>
+sshuttle --firewall --dry-run <port> <dnsport> <udpport> <subnets...>
 sshuttle --hostwatch
 --
 l,listen=          transproxy to this ip address and port number [127.0.0.1:0]
@@ -63,6 +42,12 @@ v,verbose          increase debug message verbosity
 e,ssh-cmd=         the command to use to connect to the remote [ssh]
 seed-hosts=        with -H, use these hostnames for initial scan (comma-separated)
 no-latency-control sacrifice latency to improve bandwidth benchmarks
+frame-size=        largest data payload per tunnel frame (512-65535) [16384]
+small-frames       use small frames, for latency-sensitive sessions
+workers=           number of client processes (and ssh sessions) to use [1]
+transports=        number of ssh connections each client process uses [1]
+method=            firewall backend: auto, iptables, nft or ipfw [auto]
+control=           listen for route changes on this unix socket
 wrap=              restart counting channel numbers after this number (for testing)
 D,daemon           run in the background as a daemon
 V,version          print sshuttle's version number
@@ -70,6 +55,7 @@ syslog             send log messages to syslog (default if you use --daemon)
 pidfile=           pidfile name (only if using --daemon) [./sshuttle.pid]
 server             (internal use only)
 firewall           (internal use only)
+dry-run            with --firewall, print the firewall rules instead of applying them
 hostwatch          (internal use only)
 """
 o = options.Options(optspec)
@@ -82,7 +68,6 @@ if opt.version:
 if opt.daemon:
     opt.syslog = 1
 if opt.wrap:
-    import ssnet
     ssnet.MAX_CHANNEL = int(opt.wrap)
 helpers.verbose = opt.verbose
 
@@ -91,11 +76,22 @@ try:
         if len(extra) != 0:
             o.fatal('no arguments expected')
         server.latency_control = opt.latency_control
+        server.frame_size = opt.frame_size
         sys.exit(server.main())
+    elif opt.method not in ('auto', 'iptables', 'nft', 'ipfw'):
+        o.fatal('--method must be auto, iptables, nft or ipfw')
+    elif opt.firewall and opt.dry_run:
+        if len(extra) < 3:
+            o.fatal('at least three arguments expected')
+        subnets = [(width, False, ip) for ip,width in parse_subnets(extra[3:])]
+        for k,v in flags:
+            if k in ('-x','--exclude'):
+                subnets += [(width, True, ip) for ip,width in parse_subnets([v])]
+        sys.exit(firewall.show(int(extra[0]), int(extra[1]), int(extra[2]), subnets, opt.method))
     elif opt.firewall:
         if len(extra) != 3:
             o.fatal('exactly three arguments expected')
-        sys.exit(firewall.main(int(extra[0]), int(extra[1]), int(extra[2]), opt.syslog))
+        sys.exit(firewall.main(int(extra[0]), int(extra[1]), int(extra[2]), opt.syslog, opt.method))
     elif opt.hostwatch:
         sys.exit(hostwatch.hw_main(extra))
     else:
@@ -117,6 +113,19 @@ try:
             sh = []
         else:
             sh = None
+        if opt.small_frames:
+            frame_size = ssnet.SMALL_FRAME_SIZE
+        else:
+            frame_size = int(opt.frame_size or ssnet.DEFAULT_FRAME_SIZE)
+        if frame_size < 512 or frame_size > ssnet.MAX_FRAME_SIZE:
+            o.fatal('--frame-size must be between 512 and %d'
+                    % ssnet.MAX_FRAME_SIZE)
+        workers = int(opt.workers or 1)
+        if workers < 1:
+            o.fatal('--workers must be at least 1')
+        transports = int(opt.transports or 1)
+        if transports < 1:
+            o.fatal('--transports must be at least 1')
         udp_forward = []
         if opt.udp_forward:
             opt.udp = True # Implicitly turn on
@@ -142,6 +151,7 @@ try:
                              remotename,
                              opt.python,
                              opt.latency_control,
+                             frame_size,
                              opt.dns,
                              opt.udp,
                              udp_forward,
@@ -149,7 +159,9 @@ try:
                              opt.auto_nets,
                              parse_subnets(includes),
                              parse_subnets(excludes),
-                             opt.syslog, opt.daemon, opt.pidfile))
+                             opt.syslog, opt.daemon, opt.pidfile,
+                             workers, transports, opt.method,
+                             opt.control))
 except FatalNeedsReboot, e:
     log('You must reboot before using sshuttle.\n')
     sys.exit(EXITCODE_NEEDS_REBOOT)
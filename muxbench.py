@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Measures how fast data gets through a pair of Muxes (framing, queueing,
+# parsing and dispatch; no ssh) at various maximum frame sizes.
+import sys, os, socket, time, struct
+import helpers, ssnet
+from ssnet import Mux, MuxWrapper
+
+TOTAL = 64*1024*1024
+SIZES = [2048, 4096, 8192, 16384, 32768, 65535]
+
+
+def bench(frame_size):
+    (s1,s2) = socket.socketpair()
+    tx = Mux(s1, s1)
+    rx = Mux(s2, s2)
+    tx.frame_size = rx.frame_size = frame_size
+    wrap = MuxWrapper(tx, 1)
+    got = [0, 0, 0]
+    def receive(cmd, data):
+        got[0] += len(data)
+        got[1] += 1
+        got[2] += len(data)
+        if got[2] >= ssnet.CHANNEL_WINDOW/2:
+            rx.send(1, ssnet.CMD_WINDOW_UPDATE, struct.pack('!I', got[2]))
+            got[2] = 0
+    rx.channels[1] = receive
+    block = 'x' * 65536
+    sent = 0
+    start = time.time()
+    while got[0] < TOTAL:
+        while sent < TOTAL and sent - got[0] < 1024*1024:
+            wrote = wrap.write(block)
+            if not wrote:
+                break  # out of window
+            sent += wrote
+        tx.flush()
+        rx.handle()
+        rx.flush()
+        tx.handle()
+    elapsed = time.time() - start
+    tx.channels[1] = None
+    s1.close()
+    s2.close()
+    return (elapsed, got[1])
+
+
+if __name__ == '__main__':
+    sizes = [int(i) for i in sys.argv[1:]] or SIZES
+    for size in sizes:
+        (elapsed, frames) = bench(size)
+        print '%6d bytes/frame: %8.1f MB/s %10.0f frames/s' \
+            % (size, TOTAL/elapsed/1e6, frames/elapsed)
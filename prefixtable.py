@@ -0,0 +1,76 @@
+import struct, socket
+
+# Longest-prefix-match lookups for IPv4 subnets.  Prefixes are kept in one
+# dict per width, keyed by the network as an integer, so loading one is a
+# single dict insert, and a lookup masks the address with each width that
+# is actually in use, longest first, until one matches: at most 33 dict
+# probes, and usually just a few.
+NETMASKS = [(1L << 32) - (1L << (32-width)) for width in range(33)]
+
+
+def ipint(ip):
+    # 'a.b.c.d', an ipaddr.IPv4Address or already an integer
+    if isinstance(ip, str):
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    return int(ip)
+
+
+class PrefixTable:
+    def __init__(self, prefixes=()):
+        # width -> {network: value}
+        self.nets = {}
+        self.widths = []  # the keys of nets, longest first
+        for (ip, width, value) in prefixes:
+            self.add(ip, width, value)
+
+    def __contains__(self, ip):
+        return self.match(ipint(ip), 33) is not None
+
+    def add(self, ip, width, value=True):
+        d = self.nets.get(width)
+        if d is None:
+            d = self.nets[width] = {}
+            self.widths.append(width)
+            self.widths.sort(reverse=True)
+        d[ipint(ip) & NETMASKS[width]] = value
+
+    def remove(self, ip, width):
+        # forget exactly this prefix, and return its value; KeyError if we
+        # don't have it
+        d = self.nets.get(width, {})
+        value = d.pop(ipint(ip) & NETMASKS[width])
+        if not d:
+            del self.nets[width]
+            self.widths.remove(width)
+        return value
+
+    def get(self, ip, width, default=None):
+        # the value of exactly this prefix, if we have it
+        d = self.nets.get(width)
+        if d is None:
+            return default
+        return d.get(ipint(ip) & NETMASKS[width], default)
+
+    def match(self, ip, below=33):
+        # (width, value) of the longest prefix covering the integer ip
+        # that's shorter than 'below', or None
+        for width in self.widths:
+            if width < below:
+                value = self.nets[width].get(ip & NETMASKS[width], self)
+                if value is not self:
+                    return (width, value)
+        return None
+
+    def lookup(self, ip, default=None):
+        m = self.match(ipint(ip))
+        if m is None:
+            return default
+        return m[1]
+
+    def items(self):
+        # ((width, network), value) for every prefix we have
+        l = []
+        for width in self.widths:
+            for (ip, value) in self.nets[width].items():
+                l.append(((width, ip), value))
+        return l
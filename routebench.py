@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# Measures how long the server takes to read its routing table (which it
+# does at startup, and again every so often for --auto-nets) with each of
+# the ways it knows how.
+import sys, time
+import helpers, server
+
+COUNT = 200
+READERS = [('/proc/net/route', server._proc_routes),
+           ('rtnetlink', server._netlink_routes),
+           ('netstat -rn', server._netstat_routes)]
+
+
+def bench(reader, count):
+    start = time.time()
+    for i in xrange(count):
+        routes = reader()
+    return (routes, time.time() - start)
+
+
+if __name__ == '__main__':
+    count = int((sys.argv[1:] or [COUNT])[0])
+    for (name, reader) in READERS:
+        (routes, elapsed) = bench(reader, count)
+        if routes is None:
+            print '%-16s not available here' % name
+        else:
+            print '%-16s %8.3f ms per call (%d routes)' \
+                % (name, elapsed*1000/count, len(routes))
@@ -1,8 +1,9 @@
-import re, struct, socket, select, traceback, time
+import re, struct, socket, select, traceback, time, errno, random
 if not globals().get('skip_imports'):
     import ssnet, helpers, hostwatch
     import compat.ssubprocess as ssubprocess
     from ssnet import SockWrapper, Handler, Proxy, Mux, MuxWrapper
+    from dnscache import DnsCache
     from helpers import *
 
 
@@ -46,9 +47,106 @@ def _shl(n, bits):
     return n * int(2**bits)
 
 
-def _list_routes():
+# from linux/route.h and linux/rtnetlink.h
+RTF_UP = 0x0001
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+RT_TABLE_MAIN = 254
+RTN_UNICAST = 1
+RTA_DST = 1
+
+
+# Linux: the main routing table, without forking anything.  Addresses and
+# masks are hex dumps of the raw (network order) bytes, read as a native
+# integer.
+def _proc_routes(path='/proc/net/route'):
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    routes = []
+    for line in f.readlines()[1:]:
+        cols = line.split()
+        if len(cols) < 8 or not int(cols[3], 16) & RTF_UP:
+            continue
+        ip = struct.unpack('!I', struct.pack('=I', int(cols[1], 16)))[0]
+        mask = struct.unpack('!I', struct.pack('=I', int(cols[7], 16)))[0]
+        width = _maskbits((mask,))
+        ip = ip & _shl(_shl(1, width) - 1, 32-width)
+        routes.append((socket.AF_INET,
+                       socket.inet_ntoa(struct.pack('!I', ip)), width))
+    f.close()
+    return routes
+
+
+# Linux without /proc mounted: ask the kernel directly, with an rtnetlink
+# route dump.
+def _netlink_routes():
+    try:
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    except (AttributeError, socket.error):
+        return None
+    try:
+        try:
+            # struct nlmsghdr, then struct rtmsg
+            s.sendto(struct.pack('=IHHII', 28, RTM_GETROUTE,
+                                 NLM_F_REQUEST | NLM_F_DUMP, 1, 0) +
+                     struct.pack('=BBBBBBBBI', socket.AF_INET,
+                                 0, 0, 0, 0, 0, 0, 0, 0), (0, 0))
+            return _netlink_parse(s)
+        except socket.error:
+            return None
+    finally:
+        s.close()
+
+
+def _netlink_parse(s):
+    routes = []
+    while 1:
+        data = s.recv(65536)
+        if not data:
+            return None
+        pos = 0
+        while pos + 16 <= len(data):
+            (length, msgtype) = struct.unpack('=IH', data[pos:pos+6])
+            if msgtype == NLMSG_DONE:
+                return routes
+            elif msgtype == NLMSG_ERROR or length < 16:
+                return None
+            elif msgtype == RTM_NEWROUTE:
+                (dst_len, table, rtype) = \
+                    struct.unpack('=xBxxBxxB', data[pos+16:pos+24])
+                dst = '\0\0\0\0'
+                apos = pos + 28
+                while apos + 4 <= pos + length:
+                    (alen, atype) = struct.unpack('=HH', data[apos:apos+4])
+                    if alen < 4:
+                        break
+                    if atype == RTA_DST:
+                        dst = data[apos+4:apos+8]
+                    apos += (alen + 3) & ~3
+                if table == RT_TABLE_MAIN and rtype == RTN_UNICAST:
+                    routes.append((socket.AF_INET,
+                                   socket.inet_ntoa(dst), dst_len))
+            pos += (length + 3) & ~3
+
+
+def _netstat_routes():
     argv = ['netstat', '-rn']
-    p = ssubprocess.Popen(argv, stdout=ssubprocess.PIPE)
+    # the column headings and 'default' get translated otherwise
+    env = os.environ.copy()
+    env['LC_ALL'] = 'C'
+    try:
+        p = ssubprocess.Popen(argv, stdout=ssubprocess.PIPE, env=env)
+    except OSError, e:
+        log('WARNING: %r: %s\n' % (argv, e))
+        log('WARNING: That prevents --auto-nets from working.\n')
+        return []
     routes = []
     for line in p.stdout:
         cols = re.split(r'\s+', line)
@@ -59,7 +157,8 @@ def _list_routes():
         mask = _maskbits(maskw)   # returns 32 if maskw is null
         width = min(ipw[1], mask)
         ip = ipw[0] & _shl(_shl(1, width) - 1, 32-width)
-        routes.append((socket.inet_ntoa(struct.pack('!I', ip)), width))
+        routes.append((socket.AF_INET,
+                       socket.inet_ntoa(struct.pack('!I', ip)), width))
     rv = p.wait()
     if rv != 0:
         log('WARNING: %r returned %d\n' % (argv, rv))
@@ -67,10 +166,23 @@ def _list_routes():
     return routes
 
 
+def _list_routes():
+    routes = _proc_routes()
+    if routes is None:
+        routes = _netlink_routes()
+    if routes is None:
+        routes = _netstat_routes()
+    return routes
+
+
 def list_routes():
-    for (ip,width) in _list_routes():
+    for (family,ip,width) in _list_routes():
         if not ip.startswith('0.') and not ip.startswith('127.'):
-            yield (ip,width)
+            yield (family,ip,width)
+
+
+# how often to look for routes that came or went, for --auto-nets
+ROUTE_POLL_INTERVAL = 30
 
 
 def _exc_dump():
@@ -106,58 +218,150 @@ class Hostwatch:
         self.sock = None
 
 
-class DnsProxy(Handler):
-    def __init__(self, mux, chan, request):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        Handler.__init__(self, [sock])
-        self.timeout = time.time()+30
-        self.mux = mux
+# Upstream DNS queries all go out through a few long-lived sockets, rather
+# than a new one per query.  Each query gets a fresh random transaction ID
+# for the trip upstream, so queries from different clients can't collide,
+# and we map the answer back to the original ID when it arrives.  An
+# answer only counts if it comes from port 53 of the server we asked, to
+# the socket we asked on; and since a source port that never changes
+# leaves just the ID for a spoofer to guess, we swap one socket for a
+# fresh one every so often.
+DNS_POOL_SIZE = 4
+DNS_POOL_ROTATE_INTERVAL = 60  # seconds between replacing pool sockets
+DNS_RETRY_INTERVAL = 5  # seconds before we ask (maybe another) server again
+DNS_TRIES = 3
+DNS_RESOLVCONF_MAX_AGE = 30  # seconds between rereading /etc/resolv.conf
+
+# transaction IDs have to be unguessable, which random.random() isn't
+_dns_random = random.SystemRandom()
+
+
+class DnsQuery:
+    def __init__(self, chan, request):
         self.chan = chan
+        self.request = request
         self.tries = 0
         self.peer = None
-        self.request = request
-        self.sock = sock
+        self.upstream = None
+        self.timer = None
+
+
+class DnsUpstream(Handler):
+    def __init__(self, pool):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        Handler.__init__(self, [self.sock])
         self.sock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
-        self.try_send()
+        self.sock.setblocking(False)
+        self.pool = pool
 
-    def try_send(self):
-        if self.tries >= 3:
+    def callback(self):
+        while 1:
+            try:
+                (data, peer) = self.sock.recvfrom(4096)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                elif e.args[0] in ssnet.NET_ERRS:
+                    # an ICMP error for something we sent earlier; the
+                    # retry timer will take care of it.
+                    debug2('DNS recv: %s\n' % e)
+                    continue
+                else:
+                    log('DNS recv: %s\n' % e)
+                    return
+            self.pool.got_response(self, data, peer)
+
+    def close(self):
+        self.ok = False
+        if self.hset:
+            self.hset.remove(self)
+        self.sock.close()
+
+
+class DnsPool:
+    def __init__(self, mux, handlers, cache):
+        self.mux = mux
+        self.handlers = handlers
+        self.cache = cache
+        self.upstreams = []
+        self.next_upstream = 0
+        self.next_rotate = 0
+        self.pending = {}  # upstream transaction ID -> DnsQuery
+        self.nameservers = []
+        self.nameservers_time = 0
+
+    def nameserver(self):
+        now = time.time()
+        if now - self.nameservers_time > DNS_RESOLVCONF_MAX_AGE:
+            self.nameservers = resolvconf_nameservers() or ['127.0.0.1']
+            self.nameservers_time = now
+        return random.choice(self.nameservers)
+
+    def query(self, chan, request):
+        if len(request) < 12:
             return
-        self.tries += 1
-        self.peer = resolvconf_random_nameserver()
-        self.sock.connect((self.peer, 53))
-        debug2('DNS: sending to %r\n' % self.peer)
+        if not self.upstreams:
+            for i in xrange(DNS_POOL_SIZE):
+                u = DnsUpstream(self)
+                self.upstreams.append(u)
+                self.handlers.append(u)
+            self.handlers.timers.add(DNS_POOL_ROTATE_INTERVAL, self.rotate)
+        while 1:
+            qid = _dns_random.randrange(65536)
+            if qid not in self.pending:
+                break
+        q = DnsQuery(chan, request)
+        self.pending[qid] = q
+        self.try_send(qid, q)
+
+    def rotate(self):
+        old = self.upstreams[self.next_rotate]
+        u = DnsUpstream(self)
+        self.upstreams[self.next_rotate] = u
+        self.handlers.append(u)
+        self.next_rotate = (self.next_rotate + 1) % len(self.upstreams)
+        # anything still waiting on the old socket gets retried elsewhere
+        # before then
+        self.handlers.timers.add(DNS_RETRY_INTERVAL, old.close)
+        self.handlers.timers.add(DNS_POOL_ROTATE_INTERVAL, self.rotate)
+
+    def try_send(self, qid, q):
+        if q.tries >= DNS_TRIES:
+            debug1('DNS: no answer from %r; giving up.\n' % q.peer)
+            del self.pending[qid]
+            return
+        q.tries += 1
+        q.peer = self.nameserver()
+        u = q.upstream = self.upstreams[self.next_upstream]
+        self.next_upstream = (self.next_upstream + 1) % len(self.upstreams)
+        q.timer = self.handlers.timers.add(DNS_RETRY_INTERVAL,
+                                           lambda: self.try_send(qid, q))
+        debug2('DNS: sending to %r\n' % q.peer)
         try:
-            self.sock.send(self.request)
+            u.sock.sendto(struct.pack('!H', qid) + q.request[2:],
+                          (q.peer, 53))
         except socket.error, e:
-            if e.args[0] in ssnet.NET_ERRS:
-                # might have been spurious; try again.
-                # Note: these errors sometimes are reported by recv(),
-                # and sometimes by send().  We have to catch both.
-                debug2('DNS send to %r: %s\n' % (self.peer, e))
-                self.try_send()
-                return
-            else:
-                log('DNS send to %r: %s\n' % (self.peer, e))
-                return
+            # might have been spurious; the timer will try again.
+            # Note: these errors sometimes are reported by recv(),
+            # and sometimes by send().  We have to catch both.
+            debug2('DNS send to %r: %s\n' % (q.peer, e))
 
-    def callback(self):
-        try:
-            data = self.sock.recv(4096)
-        except socket.error, e:
-            if e.args[0] in ssnet.NET_ERRS:
-                # might have been spurious; try again.
-                # Note: these errors sometimes are reported by recv(),
-                # and sometimes by send().  We have to catch both.
-                debug2('DNS recv from %r: %s\n' % (self.peer, e))
-                self.try_send()
-                return
-            else:
-                log('DNS recv from %r: %s\n' % (self.peer, e))
-                return
+    def got_response(self, u, data, peer):
+        if len(data) < 12:
+            return
+        (qid,) = struct.unpack('!H', data[:2])
+        q = self.pending.get(qid)
+        if not q or q.upstream is not u or tuple(peer[:2]) != (q.peer, 53):
+            debug2('DNS: ignoring unexpected response from %r\n' % (peer,))
+            return
+        del self.pending[qid]
+        q.timer.cancel()
+        data = q.request[:2] + data[2:]
         debug2('DNS response: %d bytes\n' % len(data))
-        self.mux.send(self.chan, ssnet.CMD_DNS_RESPONSE, data)
-        self.ok = False
+        if self.cache is not None:
+            self.cache.put(q.request, data)
+        self.mux.send(q.chan, ssnet.CMD_DNS_RESPONSE, data)
+
 
 _udp_sockets = {} # Maps port numbers to udp_socket instances
 class udp_socket(Handler):
@@ -200,6 +404,9 @@ class udp_socket(Handler):
     def close(self):
         if not self.forwarding:
             self.ok = False
+            self.wake()  # so the main loop notices and drops us
+            if _udp_sockets.get(self.source_port) is self:
+                del _udp_sockets[self.source_port]
             try:
                 self.sock.close()
             except:
@@ -209,7 +416,6 @@ class udp_channel:
     udp_channel_timeout = 600
     def __init__(self, mux, chan, handlers, source_port, destination, destination_port):
         self.original_key = struct.pack('!H4sH', source_port, destination, destination_port)
-        self.timeout = time.time() + udp_channel.udp_channel_timeout
         self.source_port = source_port
         self.destination = socket.inet_ntoa(destination)
         self.destination_port = destination_port
@@ -232,12 +438,10 @@ class udp_channel:
         except socket.error:
             self.close()
     def close(self):
-        self.ok = False
-        self.socket.removechannel(self)
-        try:
-            self.sock.close()
-        except:
-            pass
+        if self.ok:
+            self.ok = False
+            self.socket.removechannel((self.destination,
+                                       self.destination_port))
 
 def main():
     if helpers.verbose >= 1:
@@ -245,27 +449,54 @@ def main():
     else:
         helpers.logprefix = 'server: '
     debug1('latency control setting = %r\n' % latency_control)
+    max_frame = min(int(frame_size or ssnet.DEFAULT_FRAME_SIZE),
+                    ssnet.MAX_FRAME_SIZE)
+    debug1('frame size = %d\n' % max_frame)
 
     routes = list(list_routes())
     debug1('available routes:\n')
     for r in routes:
-        debug1('  %s/%d\n' % r)
+        debug1('  %s/%d\n' % r[1:])
 
-    # synchronization header
-    sys.stdout.write('\0\0SSHUTTLE0001')
+    # synchronization header, followed by the frame size we agreed to
+    sys.stdout.write('\0\0SSHUTTLE0001' + struct.pack('!H', max_frame))
     sys.stdout.flush()
 
-    handlers = []
+    handlers = ssnet.HandlerSet()
     mux = Mux(socket.fromfd(sys.stdin.fileno(),
                             socket.AF_INET, socket.SOCK_STREAM),
               socket.fromfd(sys.stdout.fileno(),
                             socket.AF_INET, socket.SOCK_STREAM))
+    mux.frame_size = max_frame
     handlers.append(mux)
     routepkt = ''
     for r in routes:
-        routepkt += '%s,%d\n' % r
+        routepkt += '%s,%d\n' % r[1:]
     mux.send(0, ssnet.CMD_ROUTES, routepkt)
 
+    # The remote network can change under us (a VPN comes up, an
+    # interface goes down...), so if the client wants --auto-nets, keep
+    # checking and tell it what changed, rather than the whole list.
+    def check_routes():
+        new = list(list_routes())
+        gone = [r for r in routes if r not in new]
+        added = [r for r in new if r not in routes]
+        if gone or added:
+            debug1('routes changed:\n')
+            changes = ''
+            for r in gone:
+                debug1('  -%s/%d\n' % r[1:])
+                changes += '-%s,%d\n' % r[1:]
+            for r in added:
+                debug1('  +%s/%d\n' % r[1:])
+                changes += '+%s,%d\n' % r[1:]
+            mux.send(0, ssnet.CMD_ROUTES_CHANGED, changes)
+            routes[:] = new
+        handlers.timers.add(ROUTE_POLL_INTERVAL, check_routes)
+    if auto_nets:
+        # nobody else cares, and it might mean forking netstat each time
+        handlers.timers.add(ROUTE_POLL_INTERVAL, check_routes)
+
     hw = Hostwatch()
     hw.leftover = ''
 
@@ -295,26 +526,39 @@ def main():
         (dstip,dstport) = data.split(',', 1)
         dstport = int(dstport)
         outwrap = ssnet.connect_dst(dstip,dstport)
-        handlers.append(Proxy(MuxWrapper(mux, channel), outwrap))
+        weight = ssnet.PORT_WEIGHTS.get(dstport, 1)
+        handlers.append(Proxy(MuxWrapper(mux, channel, weight), outwrap))
     mux.new_channel = new_channel
 
-    dnshandlers = {}
+    dnscache = DnsCache()
+    dnspool = DnsPool(mux, handlers, dnscache)
     def dns_req(channel, data):
         debug2('Incoming DNS request.\n')
-        h = DnsProxy(mux, channel, data)
-        handlers.append(h)
-        dnshandlers[channel] = h
+        response = dnscache.get(data)
+        if response:
+            debug2('DNS response from cache (%d hits, %d misses).\n'
+                   % (dnscache.hits, dnscache.misses))
+            mux.send(channel, ssnet.CMD_DNS_RESPONSE, response)
+            return
+        dnspool.query(channel, data)
     mux.got_dns_req = dns_req
 
     udphandlers = {}
     def udp_req(channel, data):
         key = struct.unpack('!H4sH', data[:8])
         udp_content = data[8:]
-        if key not in udphandlers:
+        u = udphandlers.get(key)
+        if not u or not u.ok:
             debug2('Opening UDP channel.\n')
             u = udp_channel(mux, channel, handlers, key[0], key[1], key[2])
             udphandlers[key] = u
-        udphandlers[key].send(udp_content)
+            handlers.timers.add(udp_channel.udp_channel_timeout,
+                                lambda: udp_expire(key, u))
+        u.send(udp_content)
+    def udp_expire(key, u):
+        if udphandlers.get(key) is u:
+            del udphandlers[key]
+        u.close()
     def udp_fwd(channel, data):
         handlers.append(udp_socket(mux, channel, struct.unpack('!H', data)[0], forwarding=True))
     mux.udp_out = udp_req
@@ -332,16 +576,3 @@ def main():
             mux.check_fullness()
         mux.callback()
 
-        if dnshandlers:
-            now = time.time()
-            for channel,h in dnshandlers.items():
-                if h.timeout < now or not h.ok:
-                    del dnshandlers[channel]
-                    h.ok = False
-
-        if udphandlers:
-            now = time.time()
-            for key,u in udphandlers.items():
-                if u.timeout < now or not u.ok:
-                    del udphandlers[key]
-                    u.close()
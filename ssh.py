@@ -60,6 +60,7 @@ def connect(ssh_cmd, rhostport, python, stderr, options):
                 empackage(z, 'compat/ssubprocess.py') +
                 empackage(z, 'ssnet.py') +
                 empackage(z, 'hostwatch.py') +
+                empackage(z, 'dnscache.py') +
                 empackage(z, 'server.py') +
                 "\n")
     
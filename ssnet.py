@@ -1,5 +1,7 @@
-import struct, socket, errno, select
+import struct, socket, errno, select, weakref, io, collections, itertools
+import time, heapq
 if not globals().get('skip_imports'):
+    import helpers
     from helpers import *
 
 MAX_CHANNEL = 65535
@@ -11,6 +13,40 @@ SHUT_RDWR = 2
 
 
 HDR_LEN = 8
+# largest DATA payload we put in one mux frame.  The header only has room for
+# 16 bits of length; the client and server agree on the actual value when
+# they connect.  Small frames favour latency, big ones favour throughput.
+MAX_FRAME_SIZE = 65535
+SMALL_FRAME_SIZE = 2048
+DEFAULT_FRAME_SIZE = 16384
+
+# Per-channel flow control, like ssh's channel windows: each side may only
+# have this many bytes of DATA outstanding on a channel before the receiver
+# says (with a WINDOW_UPDATE) that it has passed them on.  So a slow reader
+# only stalls its own channel, not the whole mux.
+CHANNEL_WINDOW = 1024*1024
+MUX_READ_SIZE = 32768
+# most we try to write to the mux socket per writable event.  IOV_MAX is the
+# usual limit on the number of buffers in one writev().
+MUX_WRITE_SIZE = 65536
+IOV_MAX = 1024
+# UDP goes between the firewall process and the client over a local TCP
+# connection, each datagram as a 2-byte length and then the datagram.
+DGRAM_READ_SIZE = 65536
+DGRAM_BATCH = 64  # most datagrams we take from a socket per wakeup
+# if the other end stops reading, we drop datagrams (it's UDP, after all)
+# rather than queue more than this.
+DGRAM_MAX_QUEUE = 1024*1024
+
+# Latency control: we only let the mux have about two round trips' worth of
+# data (at the bottleneck rate) outstanding, so ssh's enormous buffers don't
+# fill up and make every other session wait behind a bulk transfer.  Both
+# numbers are measured with PINGs, one per round trip, a bit like TCP BBR.
+MIN_BUDGET = 32768
+MAX_BUDGET = 64*1024*1024
+BUDGET_GAIN = 2
+BW_SAMPLES = 10  # remember the best delivery rate of this many round trips
+MIN_RTT_LIFETIME = 10.0  # seconds before we forget the smallest RTT seen
 
 
 CMD_EXIT = 0x4200
@@ -28,6 +64,8 @@ CMD_DNS_RESPONSE = 0x420b
 CMD_UDP_OUT = 0x420c
 CMD_UDP_IN = 0x420d
 CMD_UDP_FWD = 0x420e
+CMD_WINDOW_UPDATE = 0x420f
+CMD_ROUTES_CHANGED = 0x4210
 
 cmd_to_name = {
     CMD_EXIT: 'EXIT',
@@ -44,9 +82,21 @@ cmd_to_name = {
     CMD_DNS_RESPONSE: 'DNS_RESPONSE',
     CMD_UDP_OUT: 'UDP_OUT',
     CMD_UDP_IN: 'UDP_IN',
-    CMD_UDP_FWD: 'UDP_FWD'
+    CMD_UDP_FWD: 'UDP_FWD',
+    CMD_WINDOW_UPDATE: 'WINDOW_UPDATE',
+    CMD_ROUTES_CHANGED: 'ROUTES_CHANGED'
 }
 
+# Frames carrying channel data are scheduled fairly (deficit round robin)
+# between channels, so one busy channel can't make everybody else's frames
+# wait behind it.  All other frames jump the queue, unless their channel
+# already has something queued (we never reorder frames within a channel).
+BULK_CMDS = (CMD_DATA, CMD_UDP_OUT, CMD_UDP_IN)
+
+# Channels to these ports are usually interactive, so they get a bigger
+# share of the link while it's busy.  Everything else has weight 1.
+PORT_WEIGHTS = {22: 4, 23: 4, 53: 4, 3389: 4, 5900: 4}
+
 
 NET_ERRS = [errno.ECONNREFUSED, errno.ETIMEDOUT,
             errno.EHOSTUNREACH, errno.ENETUNREACH,
@@ -58,17 +108,6 @@ def _add(l, elem):
         l.append(elem)
 
 
-def _fds(l):
-    out = []
-    for i in l:
-        try:
-            out.append(i.fileno())
-        except AttributeError:
-            out.append(i)
-    out.sort()
-    return out
-
-
 def _nb_clean(func, *args):
     try:
         return func(*args)
@@ -76,7 +115,7 @@ def _nb_clean(func, *args):
         if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
             raise
         else:
-            debug3('%s: err was: %s\n' % (func.__name__, e))
+            debug3('%s: err was: %s\n', func.__name__, e)
             return None
 
 
@@ -96,29 +135,44 @@ class SockWrapper:
     def __init__(self, rsock, wsock, connect_to=None, peername=None):
         global _swcount
         _swcount += 1
-        debug3('creating new SockWrapper (%d now exist)\n' % _swcount)
+        debug3('creating new SockWrapper (%d now exist)\n', _swcount)
         self.exc = None
         self.rsock = rsock
         self.wsock = wsock
         self.shut_read = self.shut_write = False
         self.buf = []
+        self.owner = None  # weakref to the Handler moving our data around
         self.connect_to = connect_to
         self.peername = peername or _try_peername(self.rsock)
+        if rsock == wsock:
+            self.fds = '#%d' % rsock.fileno()
+        else:
+            self.fds = '#%d,%d' % (rsock.fileno(), wsock.fileno())
         self.try_connect()
 
     def __del__(self):
         global _swcount
         _swcount -= 1
-        debug1('%r: deleting (%d remain)\n' % (self, _swcount))
+        debug1('%r: deleting (%d remain)\n', self, _swcount)
         if self.exc:
-            debug1('%r: error was: %s\n' % (self, self.exc))
+            debug1('%r: error was: %s\n', self, self.exc)
 
     def __repr__(self):
-        if self.rsock == self.wsock:
-            fds = '#%d' % self.rsock.fileno()
-        else:
-            fds = '#%d,%d' % (self.rsock.fileno(), self.wsock.fileno())
-        return 'SW%s:%s' % (fds, self.peername)
+        # not fileno(): the sockets might be closed already
+        return 'SW%s:%s' % (self.fds, self.peername)
+
+    def wake(self):
+        # our state changed outside of our owner's callback; make sure it
+        # gets a look at us.
+        h = self.owner and self.owner()
+        if h:
+            h.wake()
+
+    def want_read(self, r):
+        _add(r, self.rsock)
+
+    def want_write(self, w):
+        _add(w, self.wsock)
 
     def seterr(self, e):
         if not self.exc:
@@ -133,7 +187,7 @@ class SockWrapper:
         if not self.connect_to:
             return  # already connected
         self.rsock.setblocking(False)
-        debug3('%r: trying connect to %r\n' % (self, self.connect_to))
+        debug3('%r: trying connect to %r\n', self, self.connect_to)
         if socket.inet_aton(self.connect_to[0])[0] == '\0':
             self.seterr(Exception("Can't connect to %r: "
                                   "IP address starts with zero\n"
@@ -145,7 +199,7 @@ class SockWrapper:
             # connected successfully (Linux)
             self.connect_to = None
         except socket.error, e:
-            debug3('%r: connect result: %s\n' % (self, e))
+            debug3('%r: connect result: %s\n', self, e)
             if e.args[0] == errno.EINVAL:
                 # this is what happens when you call connect() on a socket
                 # that is now connected but returned EINPROGRESS last time,
@@ -155,7 +209,7 @@ class SockWrapper:
                 realerr = self.rsock.getsockopt(socket.SOL_SOCKET,
                                                 socket.SO_ERROR)
                 e = socket.error(realerr, os.strerror(realerr))
-                debug3('%r: fixed connect result: %s\n' % (self, e))
+                debug3('%r: fixed connect result: %s\n', self, e)
             if e.args[0] in [errno.EINPROGRESS, errno.EALREADY]:
                 pass  # not connected yet
             elif e.args[0] == 0:
@@ -181,19 +235,33 @@ class SockWrapper:
 
     def noread(self):
         if not self.shut_read:
-            debug2('%r: done reading\n' % self)
+            debug2('%r: done reading\n', self)
             self.shut_read = True
             #self.rsock.shutdown(SHUT_RD)  # doesn't do anything anyway
 
     def nowrite(self):
         if not self.shut_write:
-            debug2('%r: done writing\n' % self)
+            debug2('%r: done writing\n', self)
             self.shut_write = True
             try:
                 self.wsock.shutdown(SHUT_WR)
             except socket.error, e:
                 self.seterr('nowrite: %s' % e)
 
+    def reset(self):
+        # drop the connection with a RST rather than a FIN, so the other end
+        # can't mistake whatever it got so far for the whole stream.
+        debug2('%r: resetting\n', self)
+        self.shut_read = self.shut_write = True
+        self.buf = []
+        for sock in (self.rsock, self.wsock):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+            except socket.error:
+                pass  # not a socket, or closed already
+            sock.close()
+
     def too_full(self):
         return False  # fullness is determined by the socket's select() state
 
@@ -205,7 +273,7 @@ class SockWrapper:
             return _nb_clean(os.write, self.wsock.fileno(), buf)
         except OSError, e:
             if e.errno == errno.EPIPE:
-                debug1('%r: uwrite: got EPIPE\n' % self)
+                debug1('%r: uwrite: got EPIPE\n', self)
                 self.nowrite()
                 return 0
             else:
@@ -239,22 +307,34 @@ class SockWrapper:
             self.noread()
 
     def copy_to(self, outwrap):
+        wrote = 0
         if self.buf and self.buf[0]:
-            wrote = outwrap.write(self.buf[0])
+            wrote = outwrap.write(self.buf[0]) or 0
             self.buf[0] = self.buf[0][wrote:]
         while self.buf and not self.buf[0]:
             self.buf.pop(0)
         if not self.buf and self.shut_read:
             outwrap.nowrite()
+        return wrote
 
 
 class Handler:
     def __init__(self, socks = None, callback = None):
         self.ok = True
         self.socks = socks or []
+        self.dirty = False  # queued for pre_select() before the next poll
+        self.woken = False  # queued for callback() on the next pass
+        self.polled = {}    # fd -> interest mask currently registered
+        self.hset = None    # the HandlerSet we belong to, if any
         if callback:
             self.callback = callback
 
+    def wake(self):
+        if not self.woken:
+            self.woken = True
+            if self.hset:
+                self.hset.woken.append(self)
+
     def pre_select(self, r, w, x):
         for i in self.socks:
             _add(r, i)
@@ -276,6 +356,7 @@ class Proxy(Handler):
                                 wrap2.rsock, wrap2.wsock])
         self.wrap1 = wrap1
         self.wrap2 = wrap2
+        wrap1.owner = wrap2.owner = weakref.ref(self)
 
     def pre_select(self, r, w, x):
         if self.wrap1.shut_write: self.wrap2.noread()
@@ -285,17 +366,17 @@ class Proxy(Handler):
             _add(w, self.wrap1.rsock)
         elif self.wrap1.buf:
             if not self.wrap2.too_full():
-                _add(w, self.wrap2.wsock)
+                self.wrap2.want_write(w)
         elif not self.wrap1.shut_read:
-            _add(r, self.wrap1.rsock)
+            self.wrap1.want_read(r)
 
         if self.wrap2.connect_to:
             _add(w, self.wrap2.rsock)
         elif self.wrap2.buf:
             if not self.wrap1.too_full():
-                _add(w, self.wrap1.wsock)
+                self.wrap1.want_write(w)
         elif not self.wrap2.shut_read:
-            _add(r, self.wrap2.rsock)
+            self.wrap2.want_read(r)
 
     def callback(self):
         self.wrap1.try_connect()
@@ -316,6 +397,13 @@ class Proxy(Handler):
             self.wrap1.nowrite()
             self.wrap2.nowrite()
 
+    def reset(self):
+        # one side went away uncleanly; make sure the other side knows
+        self.ok = False
+        self.wrap1.reset()
+        self.wrap2.reset()
+        self.wake()  # so the main loop notices and drops us
+
 
 class Mux(Handler):
     def __init__(self, rsock, wsock):
@@ -323,14 +411,46 @@ class Mux(Handler):
         self.rsock = rsock
         self.wsock = wsock
         self.new_channel = self.got_dns_req = self.got_routes = self.udp_out = self.udp_in = self.udp_fwd = None
-        self.got_host_req = self.got_host_list = None
+        self.got_host_req = self.got_host_list = self.got_route_changes = None
         self.channels = {}
         self.chani = 0
-        self.want = 0
-        self.inbuf = ''
-        self.outbuf = []
+        # received data lives in inbuf[inpos:inend]; we read straight into
+        # the free space after inend and parse frames in place.
+        self.inbuf = bytearray(2*MUX_READ_SIZE)
+        self.inpos = self.inend = 0
+        self.rfile = io.FileIO(rsock.fileno(), 'r', closefd=False)
+        # outbuf holds the headers and payloads we're in the middle of
+        # writing, as separate buffers; outpos is how much of outbuf[0] has
+        # already been written.  Frames wait in ctlq (control frames) or
+        # chanq (per-channel queues) until the scheduler moves them over.
+        self.outbuf = collections.deque()
+        self.outpos = 0
+        self.ctlq = collections.deque()
+        self.chanq = {}
+        self.active = collections.deque()  # channels with frames in chanq
+        self.deficit = {}
+        self.in_turn = False  # whether active[0] has had its quantum yet
+        self.weights = {}
+        # fullness is how many bytes we've queued that the other end hasn't
+        # acknowledged yet; committed counts the bytes handed to outbuf, so
+        # an answered PING tells us everything before it got there.
         self.fullness = 0
         self.too_full = False
+        self.committed = self.acked = 0
+        self.pings = {}  # payload -> (time sent, committed before it)
+        self.pingseq = 0
+        self.unmeasured = False  # sent something other than PING/PONG
+        self.rtt = self.min_rtt = None
+        self.min_rtt_time = 0
+        self.last_ack_time = None
+        self.bw_samples = collections.deque(maxlen=BW_SAMPLES)
+        self.budget = MIN_BUDGET
+        self.frame_size = DEFAULT_FRAME_SIZE
+        self.blocked = {}  # channel -> MuxWrapper waiting for too_full
+        # Losing the connection is fatal, unless we're only one of several
+        # transports: then it's up to our owner to notice that we're not ok
+        # anymore, and lost() our channels.
+        self.primary = True
         self.send(0, CMD_PING, 'chicken')
 
     def next_channel(self):
@@ -343,41 +463,111 @@ class Mux(Handler):
                 return self.chani
 
     def amount_queued(self):
-        total = 0
+        total = -self.outpos
         for b in self.outbuf:
             total += len(b)
+        for q in [self.ctlq] + self.chanq.values():
+            for frame in q:
+                total += len(frame[0]) + len(frame[1])
         return total
 
+    def has_output(self):
+        return self.outbuf or self.ctlq or self.active
+
     def check_fullness(self):
-        if self.fullness > 32768:
-            if not self.too_full:
-                self.send(0, CMD_PING, 'rttest')
+        if self.fullness > self.budget:
             self.too_full = True
+        # keep one measurement in flight while there's real traffic.  PINGs
+        # and PONGs don't count, or the two ends would keep pinging each
+        # other forever.  But while we're too full, only a PONG can unblock
+        # us, so there has to be a PING out.
+        if (self.unmeasured or self.too_full) and not self.pings:
+            self.ping()
         #ob = []
         #for b in self.outbuf:
         #    (s1,s2,c) = struct.unpack('!ccH', b[:4])
         #    ob.append(c)
         #log('outbuf: %d %r\n' % (self.amount_queued(), ob))
 
+    def ping(self):
+        self.unmeasured = False
+        self.pingseq += 1
+        data = 'rttest%d' % self.pingseq
+        # the third element tells _commit to note when this went out
+        self.ctlq.append((struct.pack('!ccHHH', 'S', 'S', 0, CMD_PING,
+                                      len(data)),
+                          data, True))
+        self.pings[data] = None
+        self.fullness += HDR_LEN + len(data)
+
+    def got_pong(self, sent, committed):
+        now = time.time()
+        self.rtt = now - sent
+        if (self.min_rtt is None or self.rtt <= self.min_rtt
+              or now - self.min_rtt_time > MIN_RTT_LIFETIME):
+            self.min_rtt = self.rtt
+            self.min_rtt_time = now
+        delivered = committed - self.acked
+        if self.last_ack_time is not None and now > self.last_ack_time:
+            self.bw_samples.append(delivered / (now - self.last_ack_time))
+        self.last_ack_time = now
+        self.acked = committed
+        self.fullness -= delivered
+        if self.bw_samples:
+            bw = max(self.bw_samples)
+            self.budget = int(min(MAX_BUDGET,
+                                  max(MIN_BUDGET,
+                                      BUDGET_GAIN * bw * self.min_rtt)))
+        else:
+            bw = 0
+        debug2('rtt=%.1fms min_rtt=%.1fms bw=%.1fk/s budget=%d'
+               ' (fullness=%d)\n',
+               self.rtt*1000, self.min_rtt*1000, bw/1024,
+               self.budget, self.fullness)
+        if self.too_full and self.fullness <= self.budget:
+            self.too_full = False
+            blocked = self.blocked
+            self.blocked = {}
+            for wrap in blocked.itervalues():
+                wrap.wake()
+        elif self.too_full and not self.pings:
+            # still too full, and everybody's waiting on us; don't count on
+            # check_fullness() getting another chance before we go to sleep.
+            self.ping()
+
     def send(self, channel, cmd, data):
         data = str(data)
         assert(len(data) <= 65535)
-        p = struct.pack('!ccHHH', 'S', 'S', channel, cmd, len(data)) + data
-        self.outbuf.append(p)
-        debug2(' > channel=%d cmd=%s len=%d (fullness=%d)\n'
-               % (channel, cmd_to_name.get(cmd,hex(cmd)),
-                  len(data), self.fullness))
-        self.fullness += len(data)
+        frame = (struct.pack('!ccHHH', 'S', 'S', channel, cmd, len(data)),
+                 data)
+        q = self.chanq.get(channel)
+        if q is not None:
+            q.append(frame)
+        elif cmd in BULK_CMDS:
+            self.chanq[channel] = collections.deque([frame])
+            self.deficit[channel] = 0
+            self.active.append(channel)
+        else:
+            self.ctlq.append(frame)
+        if helpers.verbose >= 2:
+            debug2(' > channel=%d cmd=%s len=%d (fullness=%d)\n',
+                   channel, cmd_to_name.get(cmd,hex(cmd)),
+                   len(data), self.fullness)
+        self.fullness += HDR_LEN + len(data)
+        if cmd != CMD_PONG and cmd != CMD_PING:
+            self.unmeasured = True
 
     def got_packet(self, channel, cmd, data):
-        debug2('<  channel=%d cmd=%s len=%d\n'
-               % (channel, cmd_to_name.get(cmd,hex(cmd)), len(data)))
+        if helpers.verbose >= 2:
+            debug2('<  channel=%d cmd=%s len=%d\n',
+                   channel, cmd_to_name.get(cmd,hex(cmd)), len(data))
         if cmd == CMD_PING:
             self.send(0, CMD_PONG, data)
         elif cmd == CMD_PONG:
             debug2('received PING response\n')
-            self.too_full = False
-            self.fullness = 0
+            sent = self.pings.pop(data, None)
+            if sent:
+                self.got_pong(*sent)
         elif cmd == CMD_EXIT:
             self.ok = False
         elif cmd == CMD_CONNECT:
@@ -399,6 +589,9 @@ class Mux(Handler):
                 self.got_routes(data)
             else:
                 raise Exception('got CMD_ROUTES without got_routes?')
+        elif cmd == CMD_ROUTES_CHANGED:
+            if self.got_route_changes:
+                self.got_route_changes(data)
         elif cmd == CMD_HOST_REQ:
             if self.got_host_req:
                 self.got_host_req(data)
@@ -417,68 +610,174 @@ class Mux(Handler):
             else:
                 callback(cmd, data)
 
+    def _commit(self, frame):
+        self.outbuf.append(frame[0])
+        if frame[1]:
+            self.outbuf.append(frame[1])
+        if len(frame) > 2:
+            self.pings[frame[1]] = (time.time(), self.committed)
+        size = len(frame[0]) + len(frame[1])
+        self.committed += size
+        return size
+
+    def schedule(self, want):
+        # move frames from the queues into outbuf until it holds 'want'
+        # bytes.  Keeping outbuf short is what bounds how long a frame that
+        # arrives later (eg. a keystroke) has to wait.
+        have = self.amount_committed()
+        while have < want:
+            if self.ctlq:
+                have += self._commit(self.ctlq.popleft())
+            elif self.active:
+                chan = self.active[0]
+                q = self.chanq[chan]
+                if not self.in_turn:
+                    self.deficit[chan] += ((self.frame_size + HDR_LEN)
+                                           * self.weights.get(chan, 1))
+                    self.in_turn = True
+                size = len(q[0][0]) + len(q[0][1])
+                if self.deficit[chan] < size:
+                    # used up its turn; save the rest for next time around
+                    self.active.rotate(-1)
+                    self.in_turn = False
+                    continue
+                self.deficit[chan] -= size
+                have += self._commit(q.popleft())
+                if not q:
+                    del self.chanq[chan]
+                    del self.deficit[chan]
+                    self.active.popleft()
+                    self.in_turn = False
+            else:
+                break
+
+    def amount_committed(self):
+        total = -self.outpos
+        for b in self.outbuf:
+            total += len(b)
+        return total
+
     def flush(self):
         self.wsock.setblocking(False)
-        if self.outbuf and self.outbuf[0]:
-            wrote = _nb_clean(os.write, self.wsock.fileno(), self.outbuf[0])
-            debug2('mux wrote: %r/%d\n' % (wrote, len(self.outbuf[0])))
-            if wrote:
-                self.outbuf[0] = self.outbuf[0][wrote:]
-        while self.outbuf and not self.outbuf[0]:
-            self.outbuf[0:1] = []
+        self.schedule(MUX_WRITE_SIZE)
+        if not self.outbuf:
+            return
+        # Python 2 has no writev() or sendmsg(), so gather as many queued
+        # buffers as we can into a single write() instead.  That costs one
+        # copy, but it's much cheaper than a syscall per frame.
+        if self.outpos:
+            parts = [self.outbuf[0][self.outpos:]]
+        else:
+            parts = [self.outbuf[0]]
+        total = len(parts[0])
+        for b in itertools.islice(self.outbuf, 1, IOV_MAX):
+            if total >= MUX_WRITE_SIZE:
+                break
+            parts.append(b)
+            total += len(b)
+        if len(parts) == 1:
+            chunk = parts[0]
+        else:
+            chunk = ''.join(parts)
+        try:
+            wrote = _nb_clean(os.write, self.wsock.fileno(), chunk)
+        except (IOError, OSError), e:
+            self.broken(e)
+            return
+        if helpers.verbose >= 2:
+            debug2('mux wrote: %r/%d (%d buffers)\n',
+                   wrote, total, len(parts))
+        if not wrote:
+            return
+        wrote += self.outpos
+        while self.outbuf and wrote >= len(self.outbuf[0]):
+            wrote -= len(self.outbuf.popleft())
+        self.outpos = wrote
 
     def fill(self):
         self.rsock.setblocking(False)
+        if self.inpos == self.inend:
+            self.inpos = self.inend = 0
+        elif len(self.inbuf) - self.inend < MUX_READ_SIZE and self.inpos:
+            # slide the leftover partial frame back to the front
+            n = self.inend - self.inpos
+            self.inbuf[:n] = self.inbuf[self.inpos:self.inend]
+            self.inpos = 0
+            self.inend = n
+        free = len(self.inbuf) - self.inend
+        if free < MUX_READ_SIZE:
+            # a frame bigger than what we've got room for
+            self.inbuf.extend(bytearray(MUX_READ_SIZE - free))
+        view = memoryview(self.inbuf)[self.inend:]
         try:
-            b = _nb_clean(os.read, self.rsock.fileno(), 32768)
-        except OSError, e:
-            raise Fatal('other end: %r' % e)
-        #log('<<< %r\n' % b)
-        if b == '': # EOF
+            try:
+                n = self.rfile.readinto(view)
+            except (IOError, OSError), e:
+                self.broken(e)
+                n = None
+        finally:
+            del view  # or inbuf can't be resized next time
+        if n == 0: # EOF
             self.ok = False
-        if b:
-            self.inbuf += b
+        if n:
+            self.inend += n
 
     def handle(self):
         self.fill()
-        #log('inbuf is: (%d,%d) %r\n'
-        #     % (self.want, len(self.inbuf), self.inbuf))
-        while 1:
-            if len(self.inbuf) >= (self.want or HDR_LEN):
-                (s1,s2,channel,cmd,datalen) = \
-                    struct.unpack('!ccHHH', self.inbuf[:HDR_LEN])
-                assert(s1 == 'S')
-                assert(s2 == 'S')
-                self.want = datalen + HDR_LEN
-            if self.want and len(self.inbuf) >= self.want:
-                data = self.inbuf[HDR_LEN:self.want]
-                self.inbuf = self.inbuf[self.want:]
-                self.want = 0
-                self.got_packet(channel, cmd, data)
-            else:
+        buf = self.inbuf
+        while self.inend - self.inpos >= HDR_LEN:
+            (s1,s2,channel,cmd,datalen) = \
+                struct.unpack_from('!ccHHH', buf, self.inpos)
+            assert(s1 == 'S')
+            assert(s2 == 'S')
+            start = self.inpos + HDR_LEN
+            if self.inend - start < datalen:
                 break
+            data = str(buffer(buf, start, datalen))
+            self.inpos = start + datalen
+            self.got_packet(channel, cmd, data)
+
+    def broken(self, e):
+        if self.primary:
+            raise Fatal('other end: %r' % e)
+        log('ssh transport failed: %r\n' % e)
+        self.ok = False
+
+    def lost(self):
+        # the connection underneath us is gone: shut down every channel
+        # without trying to send anything more.
+        self.ok = False
+        for callback in self.channels.values():
+            wrap = getattr(callback, 'im_self', None)
+            if isinstance(wrap, MuxWrapper):
+                wrap.lost()
+        self.channels = {}
 
     def pre_select(self, r, w, x):
         _add(r, self.rsock)
-        if self.outbuf:
+        if self.has_output():
             _add(w, self.wsock)
 
     def callback(self):
         (r,w,x) = select.select([self.rsock], [self.wsock], [], 0)
         if self.rsock in r:
             self.handle()
-        if self.outbuf and self.wsock in w:
+        if self.ok and self.has_output() and self.wsock in w:
             self.flush()
 
 
 class MuxWrapper(SockWrapper):
-    def __init__(self, mux, channel):
+    def __init__(self, mux, channel, weight=1):
         SockWrapper.__init__(self, mux.rsock, mux.wsock)
         self.mux = mux
         self.channel = channel
+        if weight != 1:
+            self.mux.weights[channel] = weight
+        self.send_window = CHANNEL_WINDOW  # how much more we may send
+        self.consumed = 0  # received bytes passed on but not yet reported
         self.mux.channels[channel] = self.got_packet
         self.socks = []
-        debug2('new channel: %d\n' % channel)
+        debug2('new channel: %d\n', channel)
 
     def __del__(self):
         self.nowrite()
@@ -499,23 +798,65 @@ class MuxWrapper(SockWrapper):
             self.mux.send(self.channel, CMD_EOF, '')
             self.maybe_close()
 
+    def lost(self):
+        # our mux is gone, so there's nobody left to tell about it, but the
+        # socket on the other side of our Proxy has to be reset.
+        self.reset()
+        h = self.owner and self.owner()
+        if h:
+            h.reset()
+
+    def reset(self):
+        # the mux's sockets aren't ours to close
+        self.shut_read = self.shut_write = True
+        self.buf = []
+
     def maybe_close(self):
         if self.shut_read and self.shut_write:
             # remove the mux's reference to us.  The python garbage collector
             # will then be able to reap our object.
             self.mux.channels[self.channel] = None
+            if self.channel in self.mux.weights:
+                del self.mux.weights[self.channel]
 
     def too_full(self):
-        return self.mux.too_full
+        if self.mux.too_full:
+            self.mux.blocked[self.channel] = self
+            return True
+        # when our window opens up again, the WINDOW_UPDATE wakes our owner
+        return self.send_window <= 0
+
+    # Our data doesn't come from, or go to, the mux socket directly: got_packet
+    # wakes our owner when something arrives, and writing only queues onto the
+    # mux.  So we never need to wait on an fd.
+    def want_read(self, r):
+        pass
+
+    def want_write(self, w):
+        self.wake()
 
     def uwrite(self, buf):
         if self.mux.too_full:
+            self.mux.blocked[self.channel] = self
             return 0  # too much already enqueued
-        if len(buf) > 2048:
-            buf = buf[:2048]
+        if self.send_window <= 0:
+            return 0  # the other end hasn't caught up with this channel
+        n = min(self.mux.frame_size, self.send_window)
+        if len(buf) > n:
+            buf = buf[:n]
         self.mux.send(self.channel, CMD_DATA, buf)
+        self.send_window -= len(buf)
         return len(buf)
 
+    def copy_to(self, outwrap):
+        wrote = SockWrapper.copy_to(self, outwrap)
+        self.consumed += wrote
+        if self.consumed >= CHANNEL_WINDOW/2 and not self.shut_read:
+            self.mux.send(self.channel, CMD_WINDOW_UPDATE,
+                          struct.pack('!I', self.consumed))
+            self.consumed = 0
+        return wrote
+
     def uread(self):
         if self.shut_read:
             return '' # EOF
@@ -523,19 +864,104 @@ class MuxWrapper(SockWrapper):
             return None  # no data available right now
 
     def got_packet(self, cmd, data):
+        self.wake()
         if cmd == CMD_EOF:
             self.noread()
         elif cmd == CMD_STOP_SENDING:
             self.nowrite()
         elif cmd == CMD_DATA:
             self.buf.append(data)
+        elif cmd == CMD_WINDOW_UPDATE:
+            self.send_window += struct.unpack('!I', data)[0]
         else:
             raise Exception('unknown command %d (%d bytes)'
                             % (cmd, len(data)))
 
 
+class DatagramStream:
+    # Length-prefixed datagrams over a stream socket, many per syscall each
+    # way: read() pulls in whatever has arrived and returns every complete
+    # datagram, and queue()d datagrams go out together on flush().  Neither
+    # one ever blocks: whatever flush() can't write now stays in outbuf
+    # (from outpos on) until the socket is writable again, which
+    # has_output() says to wait for.
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray(2*DGRAM_READ_SIZE)
+        self.inpos = self.inend = 0
+        self.outq = []
+        self.queued = 0  # bytes in outq
+        self.outbuf = ''
+        self.outpos = 0
+        self.ok = True
+
+    def fill(self):
+        if self.inpos == self.inend:
+            self.inpos = self.inend = 0
+        elif len(self.inbuf) - self.inend < DGRAM_READ_SIZE:
+            n = self.inend - self.inpos
+            self.inbuf[:n] = self.inbuf[self.inpos:self.inend]
+            self.inpos = 0
+            self.inend = n
+        view = memoryview(self.inbuf)[self.inend:]
+        try:
+            try:
+                n = self.sock.recv_into(view, 0, socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    raise
+                return
+        finally:
+            del view  # or inbuf can't be moved next time
+        if n == 0:  # EOF
+            self.ok = False
+        self.inend += n
+
+    def read(self):
+        self.fill()
+        buf = self.inbuf
+        out = []
+        while self.inend - self.inpos >= 2:
+            (datalen,) = struct.unpack_from('!H', buf, self.inpos)
+            start = self.inpos + 2
+            if self.inend - start < datalen:
+                break
+            out.append(str(buffer(buf, start, datalen)))
+            self.inpos = start + datalen
+        return out
+
+    def queue(self, data):
+        if self.queued + len(self.outbuf) - self.outpos > DGRAM_MAX_QUEUE:
+            debug2('datagram stream full; dropping %d bytes\n', len(data))
+            return
+        self.outq.append(struct.pack('!H', len(data)))
+        self.outq.append(data)
+        self.queued += 2 + len(data)
+
+    def has_output(self):
+        return self.outq or self.outpos < len(self.outbuf)
+
+    def flush(self):
+        if self.outq:
+            self.outq.insert(0, self.outbuf[self.outpos:])
+            self.outbuf = ''.join(self.outq)
+            self.outpos = 0
+            self.outq = []
+            self.queued = 0
+        while self.outpos < len(self.outbuf):
+            try:
+                self.outpos += self.sock.send(
+                    buffer(self.outbuf, self.outpos), socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    raise
+                return
+        self.outbuf = ''
+        self.outpos = 0
+
+
 def connect_dst(ip, port):
-    debug2('Connecting to %s:%d\n' % (ip, port))
+    debug2('Connecting to %s:%d\n', ip, port)
     outsock = socket.socket()
     outsock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
     return SockWrapper(outsock, outsock,
@@ -543,29 +969,345 @@ def connect_dst(ip, port):
                        peername = '%s:%d' % (ip,port))
 
 
+POLL_IN = 1
+POLL_OUT = 4
+
+
+# Fallback poller using select().  Each poll() is O(registered fds) and it
+# can't handle fds >= FD_SETSIZE, but it works everywhere.
+class SelectPoller:
+    name = 'select'
+
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, mask):
+        self.fds[fd] = mask
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+
+    def poll(self, timeout=None):
+        r = []
+        w = []
+        for fd,mask in self.fds.iteritems():
+            if mask & POLL_IN:
+                r.append(fd)
+            if mask & POLL_OUT:
+                w.append(fd)
+        if timeout is None:
+            (r,w,x) = select.select(r, w, [])
+        else:
+            (r,w,x) = select.select(r, w, [], timeout)
+        ready = {}
+        for fd in r:
+            ready[fd] = POLL_IN
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | POLL_OUT
+        return ready.items()
+
+
+# Linux epoll(); each poll() is O(ready fds).
+class EpollPoller:
+    name = 'epoll'
+
+    def __init__(self):
+        self.ep = select.epoll()
+        self.fds = {}
+
+    def _events(self, mask):
+        ev = 0
+        if mask & POLL_IN:
+            ev |= select.EPOLLIN
+        if mask & POLL_OUT:
+            ev |= select.EPOLLOUT
+        return ev
+
+    def register(self, fd, mask):
+        # If an fd gets closed and reused before we unregister it, the kernel
+        # will have dropped it from the epoll set on its own, and our idea of
+        # whether it's registered is wrong.  Just try the other way.
+        ev = self._events(mask)
+        try:
+            if fd in self.fds:
+                try:
+                    self.ep.modify(fd, ev)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self.ep.register(fd, ev)
+            else:
+                try:
+                    self.ep.register(fd, ev)
+                except IOError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    self.ep.modify(fd, ev)
+        finally:
+            self.fds[fd] = mask
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+            try:
+                self.ep.unregister(fd)
+            except IOError, e:
+                # closing an fd removes it from the epoll set automatically
+                if e.errno not in (errno.EBADF, errno.ENOENT):
+                    raise
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        out = []
+        for fd,ev in self.ep.poll(timeout):
+            mask = 0
+            if ev & (select.EPOLLIN|select.EPOLLHUP|select.EPOLLERR):
+                mask |= POLL_IN
+            if ev & (select.EPOLLOUT|select.EPOLLHUP|select.EPOLLERR):
+                mask |= POLL_OUT
+            # like select(), only report what the caller asked for
+            mask &= self.fds.get(fd, 0)
+            if mask:
+                out.append((fd, mask))
+        return out
+
+
+# BSD/MacOS kqueue(); each poll() is O(ready fds).
+class KqueuePoller:
+    name = 'kqueue'
+
+    def __init__(self):
+        self.kq = select.kqueue()
+        self.fds = {}
+
+    def _change(self, fd, old, new):
+        for bit,filt in ((POLL_IN, select.KQ_FILTER_READ),
+                         (POLL_OUT, select.KQ_FILTER_WRITE)):
+            if new & bit:
+                # even if we think it's there already: EV_ADD doesn't mind,
+                # and if the fd was closed and its number reused since
+                # then, the kernel forgot the old kevent.
+                flags = select.KQ_EV_ADD
+            elif (old & bit) and not (new & bit):
+                flags = select.KQ_EV_DELETE
+            else:
+                continue
+            try:
+                self.kq.control([select.kevent(fd, filt, flags)], 0)
+            except OSError, e:
+                # closing an fd removes its kevents automatically
+                if e.errno not in (errno.EBADF, errno.ENOENT):
+                    raise
+
+    def register(self, fd, mask):
+        self._change(fd, self.fds.get(fd, 0), mask)
+        self.fds[fd] = mask
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            self._change(fd, self.fds.pop(fd), 0)
+
+    def poll(self, timeout=None):
+        ready = {}
+        for ev in self.kq.control(None, 2*len(self.fds) + 1, timeout):
+            if ev.filter == select.KQ_FILTER_READ:
+                bit = POLL_IN
+            else:
+                bit = POLL_OUT
+            ready[ev.ident] = ready.get(ev.ident, 0) | bit
+        return ready.items()
+
+
+def make_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'kqueue'):
+        return KqueuePoller()
+    else:
+        return SelectPoller()
+
+
+# Timeouts, in a heap ordered by deadline.  Cancelling a Timer just forgets
+# its callback; dead entries get thrown away when they reach the top.
+class Timer:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+
+    def cancel(self):
+        self.callback = None
+
+
+class Timers:
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()  # keeps equal deadlines in order
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _push(self, t):
+        heapq.heappush(self.heap, (t.when, self.seq.next(), t))
+
+    def add(self, delay, callback):
+        t = Timer(time.time() + delay, callback)
+        self._push(t)
+        return t
+
+    def add_deadline(self, deadline, callback):
+        # For deadlines that keep moving, like idle timeouts: deadline() says
+        # when we're due.  When the timer goes off early, it just re-arms
+        # itself, so refreshing the deadline costs nothing, and there's only
+        # ever one heap entry per Timer.
+        def check():
+            when = deadline()
+            if when > time.time():
+                t.when = when
+                t.callback = check
+                self._push(t)
+            else:
+                callback()
+        t = Timer(deadline(), check)
+        self._push(t)
+        return t
+
+    def timeout(self):
+        # seconds until the next deadline, or None if there isn't one
+        heap = self.heap
+        while heap and not heap[0][2].callback:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(0, heap[0][0] - time.time())
+
+    def run(self):
+        now = time.time()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            t = heapq.heappop(heap)[2]
+            callback = t.callback
+            if callback:
+                t.callback = None
+                callback()
+
+
+# The set of live handlers, plus an index from each fd we're polling to the
+# handler that owns it.  Handlers are only asked to re-run pre_select() after
+# their callback has run or somebody woke them up, and dispatching a ready fd
+# is a single lookup, so each pass costs O(ready fds) rather than O(handlers).
+class HandlerSet:
+    def __init__(self, poller=None):
+        self.poller = poller or make_poller()
+        self.all = {}
+        self.byfd = {}
+        self.dirty = []  # handlers whose interest needs rechecking
+        self.woken = []  # handlers whose callback must run next pass
+        self.timers = Timers()
+        debug1('using %s poller\n', self.poller.name)
+
+    def __len__(self):
+        return len(self.all)
+
+    def __iter__(self):
+        return iter(self.all.keys())
+
+    def append(self, h):
+        self.all[h] = 1
+        h.hset = self
+        self.touch(h)
+        if h.woken:
+            self.woken.append(h)
+
+    def remove(self, h):
+        if h in self.all:
+            del self.all[h]
+            for fd in h.polled:
+                self._drop(h, fd)
+            h.polled = {}
+            h.hset = None
+
+    def touch(self, h):
+        if not h.dirty:
+            h.dirty = True
+            self.dirty.append(h)
+
+    def _drop(self, h, fd):
+        if self.byfd.get(fd) is h:
+            del self.byfd[fd]
+            self.poller.unregister(fd)
+
+    def _update(self, h):
+        h.dirty = False
+        if not h.ok or h.hset is not self:
+            self.remove(h)
+            return
+        r = []
+        w = []
+        x = []
+        h.pre_select(r, w, x)
+        want = {}
+        for s in r:
+            fd = s.fileno()
+            want[fd] = want.get(fd, 0) | POLL_IN
+        for s in w:
+            fd = s.fileno()
+            want[fd] = want.get(fd, 0) | POLL_OUT
+        old = h.polled
+        h.polled = want
+        for fd,mask in want.iteritems():
+            if old.get(fd) != mask or self.byfd.get(fd) is not h:
+                prev = self.byfd.get(fd)
+                if prev is not None and prev is not h:
+                    # prev's socket was closed and the fd number reused
+                    # before prev got cleaned up; the fd is ours now.
+                    debug3('fd %d taken over from %r\n', fd, prev)
+                    del prev.polled[fd]
+                self.byfd[fd] = h
+                self.poller.register(fd, mask)
+        for fd in old:
+            if fd not in want:
+                self._drop(h, fd)
+
+    def update(self):
+        while self.dirty:
+            dirty = self.dirty
+            self.dirty = []
+            for h in dirty:
+                self._update(h)
+
+
 def runonce(handlers, mux):
-    r = []
-    w = []
-    x = []
-    to_remove = filter(lambda s: not s.ok, handlers)
-    for h in to_remove:
-        handlers.remove(h)
-
-    for s in handlers:
-        s.pre_select(r,w,x)
-    debug2('Waiting: %d r=%r w=%r x=%r (fullness=%d/%d)\n'
-            % (len(handlers), _fds(r), _fds(w), _fds(x),
-               mux.fullness, mux.too_full))
-    (r,w,x) = select.select(r,w,x)
-    debug2('  Ready: %d r=%r w=%r x=%r\n'
-        % (len(handlers), _fds(r), _fds(w), _fds(x)))
-    ready = r+w+x
-    did = {}
-    for h in handlers:
-        for s in h.socks:
-            if s in ready:
-                h.callback()
-                did[s] = 1
-    for s in ready:
-        if not s in did:
-            raise Fatal('socket %r was not used by any handler' % s)
+    # anybody can queue data on the mux, so always recheck it.
+    handlers.touch(mux)
+    handlers.update()
+    if helpers.verbose >= 2:
+        debug2('Waiting: %d fds=%d woken=%d (fullness=%d/%d budget=%d)\n',
+               len(handlers), len(handlers.byfd), len(handlers.woken),
+               mux.fullness, mux.too_full, mux.budget)
+    if handlers.woken:
+        ready = handlers.poller.poll(0)
+    else:
+        # sleep until something happens, or the next timer is due
+        ready = handlers.poller.poll(handlers.timers.timeout())
+    if helpers.verbose >= 2:
+        debug2('  Ready: %d fds=%r\n',
+               len(handlers), sorted(fd for fd,mask in ready))
+    torun = handlers.woken
+    handlers.woken = []
+    for fd,mask in ready:
+        h = handlers.byfd.get(fd)
+        if h is None:
+            # its handler went away during an earlier callback this pass
+            debug3('fd %d is ready but has no handler\n', fd)
+            handlers.poller.unregister(fd)
+        elif not h.woken:
+            h.woken = True
+            torun.append(h)
+    for h in torun:
+        h.woken = False
+        if h.ok and h.hset is handlers:
+            h.callback()
+        handlers.touch(h)
+    handlers.timers.run()
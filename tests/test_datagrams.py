@@ -0,0 +1,38 @@
+import sys, os, socket, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import ssnet
+
+
+class DatagramStreams(unittest.TestCase):
+    def setUp(self):
+        (a, b) = socket.socketpair()
+        self.a = ssnet.DatagramStream(a)
+        self.b = ssnet.DatagramStream(b)
+
+    def tearDown(self):
+        self.a.sock.close()
+        self.b.sock.close()
+
+    def test_flush_never_blocks(self):
+        sent = ['%d' % i + 'x' * 1000 for i in range(500)]
+        for d in sent:
+            self.a.queue(d)
+            self.a.flush()  # the socket fills up long before the end
+        self.assertTrue(self.a.has_output())
+        got = []
+        while self.a.has_output():
+            got += self.b.read()
+            self.a.flush()
+        while len(got) < len(sent):
+            got += self.b.read()
+        self.assertEqual(got, sent)
+
+    def test_drops_when_full(self):
+        d = 'x' * 60000
+        for i in range(100):
+            self.a.queue(d)
+        self.assertTrue(self.a.queued <= ssnet.DGRAM_MAX_QUEUE + len(d) + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import sys, os, struct, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import dnscache
+
+QUESTION = '\7example\3com\0' + struct.pack('!HH', 1, 1)
+ANSWER = '\xc0\x0c' + struct.pack('!HHIH', 1, 1, 300, 4) + '\xc0\0\2\1'
+
+
+def opt(payload=4096, do=True, options=''):
+    return '\0' + struct.pack('!HHIH', 41, payload, do and 0x8000 or 0,
+                               len(options)) + options
+
+
+def packet(qid, flags, question, answers=(), additional=()):
+    return (struct.pack('!HHHHHH', qid, flags, question and 1 or 0,
+                        len(answers), 0, len(additional))
+            + question + ''.join(answers) + ''.join(additional))
+
+
+class DnsAnswer(unittest.TestCase):
+    def setUp(self):
+        self.request = packet(0x1234, 0x0100, QUESTION.replace('x', 'X'))
+        (qid, key, self.qend) = dnscache.dns_question(self.request)
+
+    def test_respells_question(self):
+        response = packet(0x9999, 0x8180, QUESTION, [ANSWER])
+        self.assertEqual(dnscache.dns_answer(self.request, self.qend,
+                                             response),
+                         packet(0x1234, 0x8180, self.request[12:], [ANSWER]))
+
+    def test_no_question(self):
+        # e.g. a FORMERR that doesn't echo the question back
+        response = packet(0x9999, 0x8181, '')
+        self.assertEqual(dnscache.dns_answer(self.request, self.qend,
+                                             response),
+                         packet(0x1234, 0x8181, ''))
+
+    def test_other_question(self):
+        response = packet(0x9999, 0x8185, QUESTION.replace('com', 'org'))
+        self.assertEqual(dnscache.dns_answer(self.request, self.qend,
+                                             response),
+                         '\x12\x34' + response[2:])
+
+    def test_cache_skips_no_question(self):
+        cache = dnscache.DnsCache()
+        cache.put(self.request, packet(0x1234, 0x8180, '', [ANSWER]))
+        self.assertEqual(len(cache), 0)
+        cache.put(self.request, packet(0x1234, 0x8180, QUESTION, [ANSWER]))
+        self.assertEqual(len(cache), 1)
+        again = packet(0x4321, 0x0100, QUESTION)
+        self.assertEqual(cache.get(again),
+                         packet(0x4321, 0x8180, QUESTION, [ANSWER]))
+
+
+class EdnsKey(unittest.TestCase):
+    def test_edns_then_plain(self):
+        cache = dnscache.DnsCache()
+        request = packet(0x1111, 0x0100, QUESTION, additional=[opt()])
+        response = packet(0x1111, 0x8180, QUESTION, [ANSWER], [opt()])
+        cache.put(request, response)
+        self.assertEqual(len(cache), 1)
+        # same question, but without EDNS, or asking differently
+        self.assertEqual(cache.get(packet(0x2222, 0x0100, QUESTION)), None)
+        for other in (opt(do=False), opt(payload=1232), opt(payload=100)):
+            self.assertEqual(cache.get(packet(0x2222, 0x0100, QUESTION,
+                                              additional=[other])), None)
+        self.assertEqual(cache.get(packet(0x2222, 0x0100, QUESTION,
+                                          additional=[opt()])),
+                         '\x22\x22' + response[2:])
+
+    def test_small_payloads(self):
+        # anything under 512 counts as 512
+        small = dnscache.dns_question(packet(1, 0x0100, QUESTION,
+                                             additional=[opt(100, False)]))
+        big = dnscache.dns_question(packet(1, 0x0100, QUESTION,
+                                           additional=[opt(512, False)]))
+        self.assertEqual(small, big)
+
+    def test_edns_options_not_cached(self):
+        cookie = struct.pack('!HH', 10, 8) + 'abcdefgh'
+        query = packet(0x1111, 0x0100, QUESTION,
+                       additional=[opt(options=cookie)])
+        self.assertEqual(dnscache.dns_question(query), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
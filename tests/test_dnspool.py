@@ -0,0 +1,72 @@
+import sys, os, struct, time, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import ssnet, server
+
+REQUEST = ('\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+           '\7example\3com\0\0\1\0\1')
+
+
+class FakeMux:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, channel, cmd, data):
+        self.sent.append((channel, cmd, data))
+
+
+class DnsPool(unittest.TestCase):
+    def setUp(self):
+        self.mux = FakeMux()
+        self.handlers = ssnet.HandlerSet()
+        self.pool = server.DnsPool(self.mux, self.handlers, None)
+        self.pool.nameservers = ['127.0.0.1']
+        self.pool.nameservers_time = time.time() + 3600
+        self.pool.query(7, REQUEST)
+        ((self.qid, self.q),) = self.pool.pending.items()
+        self.response = (struct.pack('!H', self.qid) + '\x81\x80'
+                         + REQUEST[4:])
+
+    def tearDown(self):
+        for u in self.pool.upstreams:
+            u.close()
+
+    def answer(self, data=None, peer=('127.0.0.1', 53), u=None):
+        self.pool.got_response(u or self.q.upstream, data or self.response,
+                               peer)
+
+    def test_accepts_the_real_answer(self):
+        self.answer()
+        self.assertEqual(self.mux.sent, [(7, ssnet.CMD_DNS_RESPONSE,
+                                          REQUEST[:2] + self.response[2:])])
+        self.assertEqual(self.pool.pending, {})
+
+    def test_ignores_impostors(self):
+        other = [u for u in self.pool.upstreams if u is not self.q.upstream]
+        self.answer(peer=('127.0.0.2', 53))
+        self.answer(peer=('127.0.0.1', 5353))
+        self.answer(u=other[0])
+        self.answer(data=struct.pack('!H', self.qid ^ 1) + self.response[2:])
+        self.answer(data=self.response[:11])
+        self.assertEqual(self.mux.sent, [])
+        self.assertEqual(self.pool.pending.keys(), [self.qid])
+        self.answer()
+        self.assertEqual(len(self.mux.sent), 1)
+
+    def test_rotate(self):
+        old = self.pool.upstreams[0]
+        self.pool.rotate()
+        self.assertTrue(old not in self.pool.upstreams)
+        self.assertEqual(len(self.pool.upstreams), server.DNS_POOL_SIZE)
+        # still listening for answers to what it already sent
+        self.assertTrue(old.ok)
+        closers = [t for (when, seq, t) in self.handlers.timers.heap
+                   if t.callback == old.close]
+        self.assertEqual(len(closers), 1)
+        self.assertTrue(closers[0].when - time.time()
+                        <= server.DNS_RETRY_INTERVAL)
+        old.close()
+        self.assertFalse(old.ok)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import sys, os, socket, struct, random, unittest, StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import firewall
+
+CHAIN = 'sshuttle-12300'
+
+
+class UpdateIptables(unittest.TestCase):
+    def setUp(self):
+        firewall.dry_run = True
+        firewall._dry_run_tables.clear()
+        firewall._dry_run_sets[:] = []
+        firewall._ipt_installed.clear()
+        self.nameservers = ['192.0.2.53']
+        self.resolvconf = firewall.resolvconf_nameservers
+        firewall.resolvconf_nameservers = lambda: list(self.nameservers)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        firewall.resolvconf_nameservers = self.resolvconf
+        firewall.dry_run = False
+
+    def chain(self):
+        (chains, rules) = firewall._dry_run_tables['nat']
+        return [r for r in rules if r.split()[1] == CHAIN]
+
+    def expect(self, subnets, use_ipset=False):
+        (nat, mangle) = firewall.ipt_rules(CHAIN, 12300, 5353, 0, subnets,
+                                           use_ipset)
+        return [' '.join(r) for r in nat]
+
+    def test_add_and_remove(self):
+        a = [(24, False, '10.0.0.0'), (8, True, '127.0.0.0')]
+        b = a + [(16, False, '192.168.0.0'), (32, True, '10.0.0.5')]
+        c = [(16, False, '192.168.0.0'), (8, True, '127.0.0.0')]
+        firewall.ipt_setup(12300, 5353, 0, a)
+        self.assertEqual(self.chain(), self.expect(a))
+        firewall.update_iptables(12300, 5353, 0, a, b)
+        self.assertEqual(self.chain(), self.expect(b))
+        firewall.update_iptables(12300, 5353, 0, b, c)
+        self.assertEqual(self.chain(), self.expect(c))
+
+    def test_nameservers_changed(self):
+        # the DNS rules that are installed have to go, not whatever
+        # resolv.conf says now
+        a = [(24, False, '10.0.0.0')]
+        b = a + [(16, False, '192.168.0.0')]
+        firewall.ipt_setup(12300, 5353, 0, a)
+        self.nameservers = ['198.51.100.53', '192.0.2.99']
+        firewall.update_iptables(12300, 5353, 0, a, b)
+        self.assertEqual(self.chain(), self.expect(b))
+
+    def test_to_and_from_ipset(self):
+        a = [(24, False, '10.0.0.0')]
+        b = a + [(32, False, '10.1.0.%d' % i) for i in range(20)]
+        firewall.ipt_setup(12300, 0, 0, a)
+        firewall.update_iptables(12300, 0, 0, a, b)
+        self.assertEqual(firewall._dry_run_sets, [CHAIN])
+        firewall.update_iptables(12300, 0, 0, b, a)
+        self.assertEqual(firewall._dry_run_sets, [])
+        (nat, mangle) = firewall.ipt_rules(CHAIN, 12300, 0, 0, a, False)
+        self.assertEqual(self.chain(), [' '.join(r) for r in nat])
+
+    def test_ipset_rolled_back(self):
+        # the chains can't change, so the set mustn't either
+        members = {}  # net -> the rest of its 'add' line
+        def ipset_restore(lines):
+            for l in lines:
+                w = l.split()
+                if w[0] == 'flush':
+                    members.clear()
+                elif w[0] == 'add':
+                    members[w[2]] = w[3:]
+                elif w[0] == 'del':
+                    del members[w[2]]
+        def ipt_restore(tables):
+            raise firewall.Fatal('iptables-restore returned 1')
+        real = (firewall.ipset_restore, firewall.ipt_restore)
+        firewall.ipset_restore = ipset_restore
+        try:
+            a = [(32, False, '10.1.0.%d' % i) for i in range(20)]
+            b = a + [(16, False, '192.168.0.0')]
+            firewall.ipt_setup(12300, 5353, 0, a)
+            before = dict(members)
+            rules = self.chain()
+            self.nameservers = ['198.51.100.53']
+            firewall.ipt_restore = ipt_restore
+            self.assertRaises(firewall.Fatal, firewall.update_iptables,
+                              12300, 5353, 0, a, b)
+        finally:
+            (firewall.ipset_restore, firewall.ipt_restore) = real
+        self.assertEqual(members, before)
+        self.assertEqual(self.chain(), rules)
+        firewall.update_iptables(12300, 5353, 0, a, b)
+        self.assertEqual(self.chain(), self.expect(b, True))
+
+
+
+def ipint(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def forwarded(subnets, ip):
+    # by brute force: the longest matching prefix wins, excludes win ties
+    best = None
+    for (width, exclude, net) in subnets:
+        mask = width and (0xffffffffL << (32-width)) & 0xffffffffL
+        if ip & mask == ipint(net) & mask:
+            if best is None or (width, bool(exclude)) > best:
+                best = (width, bool(exclude))
+    return best is not None and not best[1]
+
+
+class CollapseSubnets(unittest.TestCase):
+    def check(self, subnets, addrs):
+        rules = firewall.collapse_subnets(subnets)
+        for ip in addrs:
+            self.assertEqual(forwarded(rules, ip), forwarded(subnets, ip),
+                             '%s: %r -> %r'
+                             % (socket.inet_ntoa(struct.pack('!I', ip)),
+                                subnets, rules))
+        return rules
+
+    def test_nested_excludes(self):
+        subnets = [(16, False, '10.1.0.0'), (24, True, '10.1.2.0'),
+                   (28, False, '10.1.2.16'), (32, True, '10.1.2.17'),
+                   (24, True, '10.1.3.0')]
+        base = ipint('10.1.0.0')
+        self.assertEqual(self.check(subnets, range(base - 4, base + 1024)),
+                         [(32, True, '10.1.2.17'), (28, False, '10.1.2.16'),
+                          (23, True, '10.1.2.0'), (16, False, '10.1.0.0')])
+
+    def test_everything_but(self):
+        subnets = [(0, False, '0.0.0.0'), (8, True, '127.0.0.0'),
+                   (32, True, '192.0.2.1'), (32, False, '127.0.0.5'),
+                   (1, False, '128.0.0.0')]
+        addrs = [0, 0xffffffffL, ipint('127.0.0.5'), ipint('127.0.0.6'),
+                 ipint('192.0.2.1'), ipint('192.0.2.2'), ipint('128.0.0.0')]
+        self.assertEqual(self.check(subnets, addrs),
+                         [(32, True, '192.0.2.1'), (32, False, '127.0.0.5'),
+                          (8, True, '127.0.0.0'), (0, False, '0.0.0.0')])
+
+    def test_siblings_merge(self):
+        subnets = [(24, False, '10.0.%d.0' % i) for i in range(256)]
+        subnets.append((32, True, '10.0.3.4'))
+        self.assertEqual(self.check(subnets, [ipint('10.0.3.4'),
+                                              ipint('10.0.3.5'),
+                                              ipint('10.1.0.0')]),
+                         [(32, True, '10.0.3.4'), (16, False, '10.0.0.0')])
+
+    def test_random(self):
+        r = random.Random(1)
+        base = ipint('10.0.0.0')
+        addrs = range(base - 4, base + 600) + [0, 0xffffffffL, base + (1<<20)]
+        for trial in xrange(100):
+            subnets = []
+            for i in xrange(r.randint(1, 25)):
+                net = struct.pack('!I', base + r.randint(0, 511))
+                subnets.append((r.choice([0, 8, 20, 22, 23, 24, 25, 26, 27,
+                                          28, 29, 30, 31, 32]),
+                                r.random() < 0.3, socket.inet_ntoa(net)))
+            self.check(subnets, addrs)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
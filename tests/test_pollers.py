@@ -0,0 +1,38 @@
+import sys, os, socket, select, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import ssnet
+
+
+class Pollers(unittest.TestCase):
+    def check_fd_reuse(self, poller):
+        # a registered fd gets closed behind the poller's back, and the
+        # number comes back as a new socket.
+        (a, b) = socket.socketpair()
+        fd = a.fileno()
+        poller.register(fd, ssnet.POLL_IN)
+        a.close()
+        b.close()
+        (c, d) = socket.socketpair()
+        try:
+            self.assertEqual(c.fileno(), fd)
+            poller.register(fd, ssnet.POLL_IN)
+            d.send('x')
+            self.assertEqual(poller.poll(1), [(fd, ssnet.POLL_IN)])
+        finally:
+            c.close()
+            d.close()
+
+    def test_select(self):
+        self.check_fd_reuse(ssnet.SelectPoller())
+
+    @unittest.skipUnless(hasattr(select, 'epoll'), 'no epoll here')
+    def test_epoll(self):
+        self.check_fd_reuse(ssnet.EpollPoller())
+
+    @unittest.skipUnless(hasattr(select, 'kqueue'), 'no kqueue here')
+    def test_kqueue(self):
+        self.check_fd_reuse(ssnet.KqueuePoller())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import sys, os, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from prefixtable import PrefixTable, ipint
+
+
+class PrefixTables(unittest.TestCase):
+    def setUp(self):
+        self.t = PrefixTable([('10.0.0.0', 8, 'a'),
+                              ('10.1.0.0', 16, 'b'),
+                              ('10.1.2.0', 24, 'c'),
+                              ('10.1.2.3', 32, 'd')])
+
+    def test_longest_match(self):
+        self.assertEqual(self.t.lookup('10.1.2.3'), 'd')
+        self.assertEqual(self.t.lookup('10.1.2.4'), 'c')
+        self.assertEqual(self.t.lookup('10.1.3.4'), 'b')
+        self.assertEqual(self.t.lookup('10.2.3.4'), 'a')
+        self.assertEqual(self.t.match(ipint('10.1.2.3')), (32, 'd'))
+        self.assertEqual(self.t.match(ipint('10.1.2.3'), 32), (24, 'c'))
+        self.assertEqual(self.t.match(ipint('10.1.2.3'), 9), (8, 'a'))
+        self.assertEqual(self.t.widths, [32, 24, 16, 8])
+
+    def test_miss(self):
+        self.assertEqual(self.t.lookup('11.0.0.0'), None)
+        self.assertEqual(self.t.lookup('11.0.0.0', 'x'), 'x')
+        self.assertEqual(self.t.match(ipint('10.1.2.3'), 8), None)
+        self.assertFalse('192.168.0.1' in self.t)
+        self.assertEqual(self.t.get('10.1.2.0', 23), None)
+
+    def test_default_route(self):
+        self.assertEqual(self.t.lookup('0.0.0.0'), None)
+        self.t.add('0.0.0.0', 0, 'z')
+        self.assertEqual(self.t.lookup('0.0.0.0'), 'z')
+        self.assertEqual(self.t.lookup('255.255.255.255'), 'z')
+        self.assertEqual(self.t.lookup('10.9.9.9'), 'a')
+        # a /0 matches anything, whatever bits the address was given with
+        self.assertEqual(self.t.get('1.2.3.4', 0), 'z')
+
+    def test_host_route(self):
+        self.assertEqual(self.t.get('10.1.2.3', 32), 'd')
+        self.assertEqual(self.t.get('10.1.2.2', 32), None)
+        self.t.add('255.255.255.255', 32, 'e')
+        self.assertEqual(self.t.lookup('255.255.255.255'), 'e')
+        self.assertEqual(self.t.lookup('255.255.255.254'), None)
+
+    def test_host_bits_ignored(self):
+        self.t.add('192.168.1.77', 24, 'f')
+        self.assertEqual(self.t.get('192.168.1.0', 24), 'f')
+        self.assertEqual(self.t.lookup('192.168.1.1'), 'f')
+
+    def test_remove(self):
+        self.assertEqual(self.t.remove('10.1.2.3', 32), 'd')
+        self.assertEqual(self.t.lookup('10.1.2.3'), 'c')
+        self.assertEqual(self.t.widths, [24, 16, 8])
+        self.assertRaises(KeyError, self.t.remove, '10.1.2.3', 32)
+        self.assertRaises(KeyError, self.t.remove, '10.9.0.0', 16)
+        self.t.remove('10.1.0.0', 16)
+        self.assertEqual(self.t.lookup('10.1.3.4'), 'a')
+        self.assertEqual(sorted(self.t.items()),
+                         [((8, ipint('10.0.0.0')), 'a'),
+                          ((24, ipint('10.1.2.0')), 'c')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import sys, os, socket, struct, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import server
+
+INET = socket.AF_INET
+
+# As read on a little-endian box: each address is the raw network-order
+# bytes, hex dumped as a native integer.
+PROC_NET_ROUTE = """\
+Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT
+eth0\t00000000\t0102A8C0\t0003\t0\t0\t100\t00000000\t0\t0\t0
+eth0\t0002A8C0\t00000000\t0001\t0\t0\t100\t00FFFFFF\t0\t0\t0
+tun0\t0302010A\t00000000\t0005\t0\t0\t0\tFFFFFFFF\t0\t0\t0
+tun0\t0708090A\t00000000\t0001\t0\t0\t0\t0000FFFF\t0\t0\t0
+eth1\t000010AC\t00000000\t0000\t0\t0\t0\t0000F0FF\t0\t0\t0
+lo\t0000007F\t00000000\t0001\t0\t0\t0\t000000FF\t0\t0\t0
+"""
+
+
+def nlmsg(msgtype, body):
+    return struct.pack('=IHHII', 16 + len(body), msgtype, 0, 1, 0) + body
+
+
+def rtm_newroute(dst, dst_len, table=server.RT_TABLE_MAIN,
+                 rtype=server.RTN_UNICAST):
+    body = struct.pack('=BBBBBBBBI', INET, dst_len, 0, 0, table, 0, 0,
+                       rtype, 0)
+    if dst is not None:
+        body += struct.pack('=HH', 8, server.RTA_DST) + socket.inet_aton(dst)
+    # an RTA_OIF after it, to check we step over the other attributes
+    body += struct.pack('=HHI', 8, 4, 2)
+    return nlmsg(server.RTM_NEWROUTE, body)
+
+
+class FakeNetlink:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, bufsize):
+        if self.chunks:
+            return self.chunks.pop(0)
+        return ''
+
+
+class ProcRoutes(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.write(fd, PROC_NET_ROUTE)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    @unittest.skipIf(sys.byteorder != 'little', 'fixture is little-endian')
+    def test_parse(self):
+        self.assertEqual(server._proc_routes(self.path),
+                         [(INET, '0.0.0.0', 0),
+                          (INET, '192.168.2.0', 24),
+                          (INET, '10.1.2.3', 32),
+                          (INET, '10.9.0.0', 16),
+                          (INET, '127.0.0.0', 8)])
+
+    def test_missing(self):
+        self.assertEqual(server._proc_routes(self.path + '.missing'), None)
+
+    @unittest.skipIf(sys.byteorder != 'little', 'fixture is little-endian')
+    def test_list_routes(self):
+        real = server._list_routes
+        server._list_routes = lambda: server._proc_routes(self.path)
+        try:
+            self.assertEqual(list(server.list_routes()),
+                             [(INET, '192.168.2.0', 24),
+                              (INET, '10.1.2.3', 32),
+                              (INET, '10.9.0.0', 16)])
+        finally:
+            server._list_routes = real
+
+
+class NetlinkRoutes(unittest.TestCase):
+    def test_parse(self):
+        first = (rtm_newroute(None, 0) +
+                 rtm_newroute('192.168.2.0', 24) +
+                 rtm_newroute('127.0.0.0', 8, table=255, rtype=2))
+        second = (rtm_newroute('10.1.2.3', 32) +
+                  rtm_newroute('192.168.2.255', 32, rtype=3) +
+                  nlmsg(server.NLMSG_DONE, struct.pack('=i', 0)))
+        s = FakeNetlink([first, second])
+        self.assertEqual(server._netlink_parse(s),
+                         [(INET, '0.0.0.0', 0),
+                          (INET, '192.168.2.0', 24),
+                          (INET, '10.1.2.3', 32)])
+
+    def test_error(self):
+        s = FakeNetlink([rtm_newroute('192.168.2.0', 24) +
+                         nlmsg(server.NLMSG_ERROR, struct.pack('=i', -1))])
+        self.assertEqual(server._netlink_parse(s), None)
+
+    def test_truncated(self):
+        s = FakeNetlink([rtm_newroute('192.168.2.0', 24)])
+        self.assertEqual(server._netlink_parse(s), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
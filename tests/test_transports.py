@@ -0,0 +1,101 @@
+import sys, os, socket, struct, errno, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import ssnet
+from helpers import Fatal
+
+
+def tcp_pair():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    (b, addr) = listener.accept()
+    listener.close()
+    for s in (a, b):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return (a, b)
+
+
+def reset(sock):
+    # close with a RST, like a SIGKILLed ssh would leave us with
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+    sock.close()
+
+
+class Transports(unittest.TestCase):
+    def setUp(self):
+        self.handlers = ssnet.HandlerSet()
+        (c1, self.s1) = tcp_pair()
+        (c2, self.s2) = tcp_pair()
+        self.primary = ssnet.Mux(c1, c1)
+        self.extra = ssnet.Mux(c2, c2)
+        self.extra.primary = False
+        self.remote = ssnet.Mux(self.s1, self.s1)
+        self.got = []
+        self.remote.channels[1] = lambda cmd, data: self.got.append(data)
+        self.handlers.append(self.primary)
+        self.handlers.append(self.extra)
+        self.handlers.append(self.remote)
+        self.wrap = ssnet.MuxWrapper(self.extra, 1)
+
+    def run_loop(self, times=10):
+        # what the client's main loop does, but never waiting long
+        for i in range(times):
+            self.handlers.timers.add(0.01, lambda: None)
+            ssnet.runonce(self.handlers, self.primary)
+            for m in (self.primary, self.extra, self.remote):
+                if m.ok:
+                    m.callback()
+
+    def check_survivors(self):
+        self.assertFalse(self.extra.ok)
+        self.extra.lost()
+        self.assertTrue(self.wrap.shut_read and self.wrap.shut_write)
+        self.assertEqual(self.extra.channels, {})
+        self.primary.send(1, ssnet.CMD_DATA, 'still here')
+        self.run_loop()
+        self.assertTrue(self.primary.ok)
+        self.assertEqual(self.got, ['still here'])
+
+    def test_reset_while_reading(self):
+        self.s2.sendall('junk')  # so the close turns into a RST
+        reset(self.s2)
+        self.run_loop()
+        self.check_survivors()
+
+    def test_reset_while_writing(self):
+        reset(self.s2)
+        for i in range(10):
+            self.extra.send(1, ssnet.CMD_DATA, 'x' * 10000)
+            self.run_loop(1)
+        self.check_survivors()
+
+    def test_lost_resets_local_sockets(self):
+        (app, local) = tcp_pair()
+        proxy = ssnet.Proxy(ssnet.SockWrapper(local, local), self.wrap)
+        self.handlers.append(proxy)
+        self.wrap.got_packet(ssnet.CMD_DATA, 'partial-dat')
+        self.run_loop()
+        self.assertEqual(app.recv(4096), 'partial-dat')
+        self.extra.lost()
+        self.run_loop()
+        self.assertFalse(proxy.ok)
+        self.assertTrue(proxy not in self.handlers.all)
+        try:
+            data = app.recv(4096)
+        except socket.error, e:
+            self.assertEqual(e.args[0], errno.ECONNRESET)
+        else:
+            self.fail('got %r, not a reset' % data)
+
+    def test_primary_is_fatal(self):
+        self.s1.sendall('junk')
+        reset(self.s1)
+        self.remote.ok = False
+        self.handlers.remove(self.remote)
+        self.assertRaises(Fatal, self.run_loop)
+
+
+if __name__ == '__main__':
+    unittest.main()
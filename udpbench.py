@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Measures how many UDP packets/s get through the firewall <-> client path
+# (DatagramStream framing, udp_proxy parsing and session lookup, and the
+# replies going back), with a stand-in for the mux that answers every
+# datagram straight away.  No ssh, no server, no root.
+import sys, socket, time, struct
+import helpers, ssnet, client
+
+TOTAL = 200000
+SIZES = [64, 512, 1400]
+SESSIONS = 16
+
+
+class EchoMux:
+    def __init__(self):
+        self.channels = {}
+        self.chani = 0
+        self.replies = []
+
+    def next_channel(self):
+        self.chani += 1
+        return self.chani
+
+    def send(self, channel, cmd, data):
+        # UDP_OUT is (source_port, destination, destination_port, data);
+        # answer with a UDP_IN from the destination.
+        self.replies.append((channel, data[:8] + data[2:8] + data[8:]))
+
+    def deliver(self):
+        replies = self.replies
+        self.replies = []
+        for channel,data in replies:
+            self.channels[channel](channel, data)
+
+
+def packet(sport, size):
+    udp = struct.pack('!HHHH', sport, 9, 8 + size, 0) + 'x' * size
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64,
+                       socket.IPPROTO_UDP, 0, socket.inet_aton('127.0.0.1'),
+                       socket.inet_aton('10.0.0.1')) + udp
+
+
+def bench(size):
+    handlers = ssnet.HandlerSet()
+    mux = EchoMux()
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    proxy = client.udp_proxy(server, [], mux, handlers)
+    handlers.append(proxy)
+    fw = ssnet.DatagramStream(socket.create_connection(server.getsockname()))
+    packets = [packet(5000 + i, size) for i in range(SESSIONS)]
+    sent = got = 0
+    start = time.time()
+    while got < TOTAL:
+        while sent < TOTAL and sent - got < 4*ssnet.DGRAM_BATCH:
+            fw.queue(packets[sent % SESSIONS])
+            sent += 1
+        fw.flush()
+        handlers.update()
+        for fd,mask in handlers.poller.poll(0):
+            proxy.callback()
+        mux.deliver()
+        proxy.callback()  # flush the replies
+        got += len(fw.read())
+    elapsed = time.time() - start
+    fw.sock.close()
+    server.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    sizes = [int(i) for i in sys.argv[1:]] or SIZES
+    for size in sizes:
+        elapsed = bench(size)
+        print '%5d bytes/packet: %9.0f packets/s each way' \
+            % (size, TOTAL/elapsed)